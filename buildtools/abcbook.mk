@@ -30,6 +30,9 @@ SHELL = /bin/bash
     # stdout+stderr IO redirection with "&>" does not work with dash.
 LILYPOND_BOOK = lilypond-book
 ABC2LY = abc4ly.py
+# Single entry point of the Python build tools (abcsplit.py,
+# gen_tex_tunebook.py, abcbuild.py), see abcbook.py
+ABCBOOK = abcbook.py
 
 build_outdir = _build
 stage1_outdir = $(build_outdir)/out.stage1
@@ -67,7 +70,7 @@ $(stage2_outdir) : $(build_outdir)
 
 $(build_outdir)/splitabc.mk : $(BOOKNAME).abc $(build_outdir)
 	@echo [ABCSPLIT] $(BOOKNAME).abc
-	abcsplit.py -o $(abcsplit_outdir) $(BOOKNAME).abc
+	$(ABCBOOK) split -o $(abcsplit_outdir) $(BOOKNAME).abc
 	echo "SPLIT_ABC=`echo $(abcsplit_outdir)/*.abc`" > $(build_outdir)/splitabc.mk
 
 $(stage1_outdir)/%.ly : $(src)/%.abc
@@ -98,8 +101,10 @@ $(stage1_outdir)/$(BOOKNAME).lytex : $(BOOKNAME).abc \
                                      bookspecs/tune_files.txt \
                                      bookspecs/tune_sets.txt \
                                      $(GUITAR_CHORDS)
+# Note: gen_tex_tunebook.py does not touch the .lytex file if its content is
+# unchanged, so that lilypond-book is not run again for nothing.
 	@echo [GEN-TEX-TUNEBOOK]
-	gen_tex_tunebook.py --bookname $(BOOKNAME) --output-dir $(stage1_outdir)
+	$(ABCBOOK) gen-tex --bookname $(BOOKNAME) --output-dir $(stage1_outdir)
 
 $(stage2_outdir)/$(BOOKNAME).tex : $(stage1_outdir)/$(BOOKNAME).lytex \
                                    $(lyfiles) $(lyfiles2) $(lyfiles3) \
@@ -142,6 +147,21 @@ $(stage2_outdir)/$(BOOKNAME).pdf : $(stage2_outdir)/$(BOOKNAME).ps
 	@cd $(stage2_outdir) && ps2pdf -sPAPERSIZE=a4 $(BOOKNAME).ps
 
 
+# ------------------------------------------------------------------------ 
+#     Single-interpreter build
+# ------------------------------------------------------------------------ 
+
+# The rules above run a Python interpreter for each step.  These targets
+# run all the Python steps (split, ABC conversions, .lytex generation) in a
+# single interpreter, with parallel conversions: see abcbuild.py.
+build-lytex build-dvi build-ps build-pdf :
+	@echo [ABCBOOK BUILD] $(patsubst build-%,%,$@)
+	$(ABCBOOK) build --bookname $(BOOKNAME) --abc2ly $(ABC2LY) \
+            $(patsubst build-%,%,$@)
+
+.PHONY : build-lytex build-dvi build-ps build-pdf
+
+
 # ------------------------------------------------------------------------ 
 #     View the tunebook
 # ------------------------------------------------------------------------ 
@@ -186,6 +206,7 @@ clean :
 	-rm -rf $(stage2_outdir)
 	-rm -rf $(abcsplit_outdir)
 	-rm -f $(build_outdir)/splitabc.mk
+	-rm -f $(build_outdir)/tune_metadata_cache.json
 	-rm -f src/*.mid
 	-rm -f *~
 	-rm -f src/*~
@@ -205,6 +226,8 @@ help :
 	@echo "        default: dvi format"
 	@echo "        ps: Postcript format"
 	@echo "        pdf: pdf format"
+	@echo "        build-dvi, build-ps, build-pdf: same formats, built by"
+	@echo "            abcbook.py in a single Python interpreter"
 	@echo "Other targets:"
 	@echo "        view: view the book in dvi format"
 	@echo "        viewpdf: view the book in PDF format"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+Single entry point of the abcbook build tools
+
+    abcbook.py <command> [options]
+
+The commands are the build tools of abcbook, with the same options:
+
+    split:    abcsplit.py
+    gen-tex:  gen_tex_tunebook.py
+    build:    abcbuild.py
+    serve:    tunebook_server.py
+
+Only the modules of the requested command are imported, so that starting
+abcbook.py is not slower than starting the tool itself.  'abcbook.py build'
+runs all the Python steps of a build in a single interpreter.
+"""
+
+# Imports from the Python Standard Library:
+# Note: only the modules which are imported by the interpreter at startup
+# anyway, see test_abcbook.py
+import importlib
+import sys
+
+
+# command => (module, description)
+COMMANDS = {
+    'split': ('abcsplit', 'split ABC files into one file per tune'),
+    'gen-tex': ('gen_tex_tunebook', 'generate the LilyPond book of a '
+                                    'tunebook'),
+    'build': ('abcbuild', 'build a tunebook'),
+    'serve': ('tunebook_server', 'generate tunebooks on demand'),
+}
+
+
+def usage() -> str:
+    lines = ['usage: abcbook.py <command> [options]', '',
+             'commands:']
+    for command, (module, description) in COMMANDS.items():
+        lines.append('  {0:<10}{1} ({2}.py)'.format(command, description,
+                                                   module))
+    lines.append('')
+    lines.append("Run 'abcbook.py <command> --help' for the options of a "
+                 "command.")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Run the command of the command line.  argv are the command line
+    arguments, sys.argv[1:] if None."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+    if argv[0] not in COMMANDS:
+        print('abcbook.py: unknown command: {0}\n'.format(argv[0]),
+              file=sys.stderr)
+        print(usage(), file=sys.stderr)
+        return 2
+
+    module = importlib.import_module(COMMANDS[argv[0]][0])
+    return module.main(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+Build a tunebook with a pool of parallel jobs
+
+This is an alternative to abcbook.mk, which uses the same directory layout
+and tools:
+
+    split:   <bookname>.abc => _build/splitabc/<label>.abc  (abcsplit.py)
+    convert: *.abc => _build/out.stage1/*.ly               (abc4ly.py)
+             *.ly => _build/out.stage1/*.ly                (copy)
+    book:    tune list => _build/out.stage1/<bookname>.lytex
+                                                     (gen_tex_tunebook.py)
+             .lytex => _build/out.stage2/<bookname>.tex    (lilypond-book)
+             .tex => .dvi => .ps => .pdf          (latex, dvips, ps2pdf)
+
+Unlike the Makefile, the tunes to build are read from tune_files.txt, and
+the main multi-tune ABC file is split before the conversions are
+scheduled, so that each of its tunes is converted as a separate job.  The
+conversions are run by a pool of workers (one per CPU by default) and are
+skipped for the tunes whose .ly file is up to date.
+"""
+
+# Standard Python modules:
+# Note: concurrent.futures is slow to import and only used by the
+# conversions, so it is imported where it is used (see test_abcbook.py)
+import argparse
+import hashlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+from typing import Callable, List, Tuple
+
+# Imports from the project library:
+from abcparser import AbcError, Tune, read_abc_file
+from abcsplit import (LabelCollisionError, check_label_collisions,
+                      write_split_files)
+from artifactcache import (DEFAULT_MAX_SIZE, ArtifactCache, default_cache_dir,
+                           evict_snippets, touch_snippets)
+import gen_tex_tunebook
+from gen_tex_tunebook import read_tune_file_list
+
+
+ARGS = None  # Command line arguments after parsing
+
+# Directory layout, as in abcbook.mk
+BUILD_OUTDIR = Path('_build')
+STAGE1_OUTDIR = BUILD_OUTDIR / 'out.stage1'
+STAGE2_OUTDIR = BUILD_OUTDIR / 'out.stage2'
+ABCSPLIT_OUTDIR = BUILD_OUTDIR / 'splitabc'
+BOOKSPECS_DIR = Path('bookspecs')
+
+TARGETS = ['lytex', 'dvi', 'ps', 'pdf']
+
+
+class BuildError(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------------
+#     Entry point & CLI arguments parsing
+# ----------------------------------------------------------------------------
+
+def main(argv: List[str] = None):
+    global ARGS
+
+    ARGS = parse_args(argv)
+    setup_logging()
+
+    cache_dir = None
+    if not ARGS.no_cache:
+        cache_dir = Path(ARGS.cache_dir) if ARGS.cache_dir \
+            else default_cache_dir()
+
+    try:
+        build(ARGS.target, ARGS.bookname, ARGS.jobs, ARGS.abc2ly,
+              cache_dir, ARGS.cache_size * 1024 * 1024,
+              Path(ARGS.tune_file_list),
+              Path(ARGS.tune_sets) if ARGS.tune_sets else None)
+    except BuildError as e:
+        logging.error('%s', e)
+        sys.exit(1)
+
+
+def parse_args(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description='Build a tunebook (to be run from the tunebook '
+                    'root directory)')
+    parser.add_argument('-d', '--debug',
+                        help='show debug messages',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbosity level')
+    parser.add_argument('-b', '--bookname', type=str, default='tunebook',
+                        help='base name of the tunebook file name')
+    parser.add_argument('-f', '--tune-file-list', type=str,
+                        default=str(BOOKSPECS_DIR / 'tune_files.txt'),
+                        help='path to the file with the list of tune files '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--tune-sets', type=str,
+                        help='path to the file with the list of tune sets '
+                             '(default: see gen_tex_tunebook.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of tunes to convert in parallel '
+                             '(default: number of CPUs)')
+    parser.add_argument('--abc2ly', type=str, default='abc4ly.py',
+                        help='ABC to LilyPond converter')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory of the cache of converted and '
+                             'engraved tunes, shared by all the tunebooks '
+                             '(default: ~/.cache/abcbook)')
+    parser.add_argument('--cache-size', type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help='maximum size of the cache of converted and '
+                             'engraved tunes, in MB (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the cache of converted and '
+                             'engraved tunes')
+    parser.add_argument('target', nargs='?', choices=TARGETS, default='dvi',
+                        help='file format to build (default: dvi)')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def setup_logging():
+    if ARGS.debug:
+        logging_level = logging.DEBUG
+    elif ARGS.verbose:
+        logging_level = logging.INFO
+    else:
+        logging_level = logging.WARNING
+    logging.basicConfig(level=logging_level, format='<%(levelname)s> %(message)s')
+
+
+# ----------------------------------------------------------------------------
+#     Build logic
+# ----------------------------------------------------------------------------
+
+def build(target: str, bookname: str, jobs: int, abc2ly: str = 'abc4ly.py',
+          cache_dir: Path = None, cache_size: int = DEFAULT_MAX_SIZE,
+          tune_files_path: Path = BOOKSPECS_DIR / 'tune_files.txt',
+          tune_sets_path: Path = None):
+    """
+    Build a tunebook
+
+    Args:
+        target: one of TARGETS
+
+        bookname: base name of the tunebook file name
+
+        jobs: number of tunes to convert in parallel
+
+        abc2ly: ABC to LilyPond converter command
+
+        cache_dir: if not None, directory of the cache of converted tunes
+            ('ly' subdirectory) and engraved tunes ('lilypond-book'
+            subdirectory, written by lilypond-book itself)
+
+        cache_size: maximum size of the cache of converted and engraved
+            tunes, in bytes
+
+        tune_files_path: path of the list of tune files
+
+        tune_sets_path: if not None, path of the list of tune sets, instead
+            of the default of gen_tex_tunebook.py
+
+    Raises:
+        BuildError if a build step fails
+    """
+    for outdir in (STAGE1_OUTDIR, STAGE2_OUTDIR):
+        os.makedirs(str(outdir), exist_ok=True)
+
+    tune_file_paths = read_tune_file_list(tune_files_path)
+    conversions = plan_conversions(tune_file_paths, bookname)
+    cache = None
+    if cache_dir is not None:
+        cache = ArtifactCache(cache_dir / 'ly', cache_size)
+    run_conversions(conversions, jobs, TuneConverter(abc2ly, cache))
+    ly_cache_size = 0
+    if cache is not None:
+        ly_cache_size = cache.evict()
+
+    lytex_path = STAGE1_OUTDIR / (bookname + '.lytex')
+    argv = ['--bookname', bookname, '--output-dir', str(STAGE1_OUTDIR),
+            '--tune-file-list', str(tune_files_path)]
+    if tune_sets_path is not None:
+        argv += ['--tune-sets', str(tune_sets_path)]
+    # Run in this interpreter rather than in a new one: gen_tex_tunebook is
+    # already imported
+    run_main_step('GEN-TEX-TUNEBOOK', gen_tex_tunebook.main, argv)
+    if target == 'lytex':
+        return
+
+    tex_path = STAGE2_OUTDIR / (bookname + '.tex')
+    if not is_up_to_date(tex_path, [lytex_path] +
+                         [ly_path for _, ly_path in conversions]):
+        command = ['lilypond-book']
+        if cache_dir is not None:
+            # lilypond-book names the engraved snippets after the hash of
+            # their content: they can be shared by all the tunebooks
+            command.append('--lily-output-dir=' +
+                           str((cache_dir / 'lilypond-book').resolve()))
+        command.append('../../' + str(lytex_path))
+        run_step('LILYPOND-BOOK', command, cwd=STAGE2_OUTDIR,
+                 log_path=STAGE2_OUTDIR / 'lilypond-book.log')
+    if cache_dir is not None:
+        # The engraved tunes share the size limit of the cache: the
+        # converted tunes are smaller and take precedence
+        snippet_dir = cache_dir / 'lilypond-book'
+        touch_snippets(snippet_dir, tex_path)
+        evict_snippets(snippet_dir, max(0, cache_size - ly_cache_size))
+
+    dvi_path = STAGE2_OUTDIR / (bookname + '.dvi')
+    if not is_up_to_date(dvi_path, [tex_path]):
+        # Note: we call LaTeX twice to get the cross refs right (index)
+        run_step('LATEX pass 1',
+                 ['latex', '-halt-on-error', '-interaction=batchmode',
+                  bookname + '.tex'],
+                 cwd=STAGE2_OUTDIR, log_path=STAGE2_OUTDIR / 'latex1.log')
+        run_step('LATEX pass 2',
+                 ['latex', '-interaction=batchmode', bookname + '.tex'],
+                 cwd=STAGE2_OUTDIR, log_path=STAGE2_OUTDIR / 'latex2.log')
+    if target == 'dvi':
+        return
+
+    ps_path = STAGE2_OUTDIR / (bookname + '.ps')
+    if not is_up_to_date(ps_path, [dvi_path]):
+        run_step('DVIPS', ['dvips', '-o', bookname + '.ps', bookname + '.dvi'],
+                 cwd=STAGE2_OUTDIR)
+    if target == 'ps':
+        return
+
+    pdf_path = STAGE2_OUTDIR / (bookname + '.pdf')
+    if not is_up_to_date(pdf_path, [ps_path]):
+        run_step('PS2PDF', ['ps2pdf', '-sPAPERSIZE=a4', bookname + '.ps'],
+                 cwd=STAGE2_OUTDIR)
+
+
+def plan_conversions(tune_file_paths: List[Path],
+                     bookname: str) -> List[Tuple[Path, Path]]:
+    """
+    Split the main ABC file and list the tune files to convert to LilyPond
+
+    Args:
+        tune_file_paths: tune files listed in tune_files.txt
+
+        bookname: base name of the tunebook file name, also base name of
+            the main multi-tune ABC file
+
+    Returns:
+        A list of (source path, .ly path) tuples, one per tune
+
+    Raises:
+        BuildError if a tune file cannot be read or parsed, or if several
+        tunes would be converted to the same .ly file
+    """
+    # The tunes of the main ABC file are converted to <label>.ly, the other
+    # tune files to <file name>.ly
+    tunes_by_file = {}
+    for path in tune_file_paths:
+        if path.suffix == '.abc' and path.stem == bookname:
+            try:
+                tunes_by_file[path] = read_abc_file(path)
+            except (AbcError, OSError) as e:
+                raise BuildError('Failed to parse ABC file: {0}: {1}'
+                                 .format(path, e)) from e
+        elif path.suffix in ('.abc', '.ly'):
+            tune = Tune(path.name, path=path)
+            tune.label = path.stem
+            tunes_by_file[path] = [tune]
+        else:
+            raise BuildError('Unsupported tune file type for: {0}'
+                             .format(path))
+    # Check before any job is scheduled: two jobs must not write the same
+    # file at the same time
+    try:
+        check_label_collisions(tunes_by_file)
+    except LabelCollisionError as e:
+        raise BuildError(str(e)) from e
+
+    conversions = []
+    for path, tunes in tunes_by_file.items():
+        if path.suffix == '.abc' and path.stem == bookname:
+            print('[ABCSPLIT] {0}'.format(path))
+            write_split_files({path: tunes}, ABCSPLIT_OUTDIR)
+            for tune in tunes:
+                conversions.append((ABCSPLIT_OUTDIR / (tune.label + '.abc'),
+                                    STAGE1_OUTDIR / (tune.label + '.ly')))
+        else:
+            conversions.append((path, STAGE1_OUTDIR / (path.stem + '.ly')))
+    return conversions
+
+
+def run_conversions(conversions: List[Tuple[Path, Path]], jobs: int,
+                    converter: 'TuneConverter'):
+    """
+    Convert the tune files that are not up to date to LilyPond, with a pool
+    of 'jobs' parallel workers.
+
+    Raises:
+        BuildError if at least one conversion failed
+    """
+    todo = [(src, ly) for src, ly in conversions
+            if not is_up_to_date(ly, [src])]
+    logging.info('%d tunes to convert, %d up to date', len(todo),
+                 len(conversions) - len(todo))
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(converter.convert, src, ly): src
+                   for src, ly in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            src = futures[future]
+            try:
+                status = future.result()
+            except BuildError as e:
+                errors.append(str(e))
+                status = 'FAILED'
+            print('[{0}/{1}] {2} {3}'.format(done, len(todo), src, status))
+
+    if errors:
+        raise BuildError('{0} tune conversions failed:\n{1}'
+                         .format(len(errors), '\n'.join(errors)))
+
+
+class TuneConverter:
+    """
+    Convert tune files to LilyPond files in stage 1 directory, reusing the
+    LilyPond files of the artifact cache, if any.
+
+    The cache key of a converted tune depends on the content and name of
+    the ABC file and on the content of the converter script.
+    """
+    def __init__(self, abc2ly: str, cache: ArtifactCache = None):
+        self.abc2ly = abc2ly
+        self.cache = cache
+        self._converter_id = abc2ly
+        converter_path = shutil.which(abc2ly)
+        if converter_path is not None:
+            with open(converter_path, 'rb') as f:
+                self._converter_id = hashlib.sha1(f.read()).hexdigest()
+
+    def convert(self, src: Path, ly_path: Path) -> str:
+        """
+        Convert a tune file
+
+        Returns:
+            'OK', or 'CACHED' if the LilyPond file came from the cache
+
+        Raises:
+            BuildError if the conversion failed
+        """
+        if src.suffix == '.ly':
+            shutil.copyfile(str(src), str(ly_path))
+            return 'OK'
+
+        log_path = ly_path.with_suffix('.abc2ly.log')
+        key = None
+        if self.cache is not None:
+            with open(src, 'rb') as f:
+                key = ArtifactCache.key(self._converter_id, src.name, f.read())
+            if (self.cache.get(key, ly_path)
+                    and self.cache.get(ArtifactCache.key(key, 'log'),
+                                       log_path)):
+                self._report_warnings(src, log_path)
+                return 'CACHED'
+
+        with open(log_path, 'w') as log:
+            try:
+                result = subprocess.run(
+                    [self.abc2ly, '-o', str(ly_path), str(src)],
+                    stdout=subprocess.DEVNULL, stderr=log)
+            except OSError as e:
+                raise BuildError('{0}: cannot run {1}: {2}'
+                                 .format(src, self.abc2ly, e))
+        self._report_warnings(src, log_path)
+        if result.returncode != 0:
+            raise BuildError('{0}: {1} failed (see {2})'
+                             .format(src, self.abc2ly, log_path))
+
+        if key is not None:
+            self.cache.put(key, ly_path)
+            self.cache.put(ArtifactCache.key(key, 'log'), log_path)
+        return 'OK'
+
+    @staticmethod
+    def _report_warnings(src: Path, log_path: Path):
+        with open(log_path, 'r') as log:
+            for line in log:
+                if 'Warning' in line and 'Q specification' not in line:
+                    logging.warning('%s: %s', src, line.rstrip())
+
+
+def run_step(name: str, command: List[str], cwd: Path = None,
+             log_path: Path = None):
+    """Run a book generation step, aborting the build if it fails"""
+    print('[{0}]'.format(name))
+    logging.debug('Running: %s', ' '.join(command))
+    log = open(log_path, 'w') if log_path else None
+    try:
+        result = subprocess.run(command, cwd=str(cwd) if cwd else None,
+                                stdout=log, stderr=subprocess.STDOUT if log
+                                else None)
+    except OSError as e:
+        raise BuildError('{0}: cannot run {1}: {2}'
+                         .format(name, command[0], e))
+    finally:
+        if log:
+            log.close()
+    if result.returncode != 0:
+        message = '{0} failed'.format(name)
+        if log_path:
+            message += ' (see {0})'.format(log_path)
+        raise BuildError(message)
+
+
+def run_main_step(name: str, main: Callable[[List[str]], None],
+                  argv: List[str]):
+    """Run a book generation step implemented by the main() function of
+    one of the build tools, aborting the build if it fails"""
+    print('[{0}]'.format(name))
+    logging.debug('Running: %s %s', name, ' '.join(argv))
+    try:
+        main(argv)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise BuildError('{0} failed'.format(name))
+
+
+def is_up_to_date(target: Path, sources: List[Path]) -> bool:
+    """Return True if target exists and is newer than all the sources"""
+    try:
+        target_mtime = os.stat(str(target)).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    for source in sources:
+        try:
+            if os.stat(str(source)).st_mtime_ns > target_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,17 @@
 
 
 # Imports from the Python Standard Library:
+# Note: json (parser traces) and mmap (lazy parsing) are imported where
+# they are used, as the CLI tools importing this module seldom need them.
+import io
+import locale
 import logging
-from functools import total_ordering
+from functools import lru_cache, total_ordering
 from pathlib import Path
 import string
 import sys
-from typing import List
+from typing import List, Optional, TextIO, Tuple
+import unicodedata
 
 
 # ------------------------------------------------------------------------
@@ -18,7 +23,16 @@ from typing import List
 @total_ordering
 class Tune:
     """Store a tune's metadata and can be sorted based on title
+
+    Whole archives of tunes may be loaded, so a tune has no per-instance
+    __dict__, and only the attributes used by the tools.  Most of the memory
+    of a tune parsed by parse_abc_file() is its text: parse the files with
+    lazy=True when the text is not needed, eg to index the tunes: it takes
+    less than a third of the memory (see TestTuneMemory in test_abcparser.py).
     """
+    __slots__ = ('path', 'index', 'title', 'type', 'label', 'title_for_index',
+                 '_sort_key', 'span', '_text')
+
     def __init__(self, title=None, tune_type=None, index=None, path=None):
         self.path = path  # Path to the ABC file containing the tune
         self.index = index  # ABC tune index (X: header)
@@ -26,25 +40,56 @@ class Tune:
         self.type = tune_type  # Reel, Jig, ...
         self.label = None  # Tune label is tune identifier
         self.title_for_index = None
-        self.text = ''
+        self._sort_key = None  # See sort_key
+        # (start, end) byte offsets of the tune in path, only for the tunes
+        # parsed with lazy=True
+        self.span = None
+        self._text = ''
 
         self.set_title(title)
 
+    @property
+    def text(self) -> str:
+        """ABC text of the tune
+
+        For tunes parsed with parse_abc_file(lazy=True), the text is read
+        from the ABC file and decoded on first access only.
+        """
+        if self._text is None:
+            self._text = read_tune_text(self.path, self.span)
+        return self._text
+
+    @text.setter
+    def text(self, text: Optional[str]):
+        self._text = text
+
+    @property
+    def sort_key(self) -> Optional[str]:
+        """Key to sort tunes in the index (see title_to_sort_key)
+
+        The key is computed on first access only: most tools never sort the
+        tunes they parse.
+        """
+        if self._sort_key is None and self.title_for_index is not None:
+            self._sort_key = title_to_sort_key(self.title_for_index)
+        return self._sort_key
+
     def set_title(self, title):
         self.title = title
         if self.title is not None:
             self.label = title_to_label(self.title)
             self.title_for_index = demote_determinant(self.title)
+            self._sort_key = None
 
     def __eq__(self, other):
-        return self.title_for_index.lower() == other.title_for_index.lower()
+        return self.sort_key == other.sort_key
 
     def __lt__(self, other):
-        return self.title_for_index.lower() < other.title_for_index.lower()
+        return self.sort_key < other.sort_key
 
     def __cmp__(self, other):
-        x = self.title_for_index.lower()
-        y = other.title_for_index.lower()
+        x = self.sort_key
+        y = other.sort_key
         if x > y:
             return 1
         elif x == y:
@@ -78,13 +123,76 @@ def demote_determinant(title: str) -> str:
         return title
 
 
+def fold_accents(text: str) -> str:
+    """Remove the accents from a text, eg 'Ó Raghallaigh' => 'O Raghallaigh'
+
+    Args:
+        text: any text
+
+    Returns:
+        the text where each accented letter is replaced with its base letter
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def title_to_sort_key(title_for_index: str) -> str:
+    """Compute the key used to sort tunes in the index
+
+    Titles are compared without accents and case, so that eg 'Ó Raghallaigh's'
+    sorts with the titles starting with an 'O' and not after 'Z'.  (Titles
+    that only differ by their accents have the same label, so they cannot be
+    in the same tunebook.)
+
+    Args:
+        title_for_index: tune title with demoted determinant
+
+    Returns:
+        the sort key
+    """
+    return fold_accents(title_for_index).casefold()
+
+
+LABEL_CHARS = frozenset(string.ascii_lowercase + string.digits)
+
+
+def _label_char(c: str) -> str:
+    """Return the label character for a lower case title character"""
+    if c in LABEL_CHARS:
+        return c
+    # Accented letter: keep the base letter if it is a valid label character
+    base = unicodedata.normalize('NFD', c)
+    if base[0] in LABEL_CHARS and all(unicodedata.combining(accent)
+                                      for accent in base[1:]):
+        return base[0]
+    return '_'
+
+
+class _LabelTranslationTable(dict):
+    """str.translate() table: character code => label character
+
+    The table is filled at import time for the Latin-1 and Latin Extended
+    characters, which cover the tune titles in practice, and completed on
+    the fly for any other character.
+    """
+    def __missing__(self, code: int) -> str:
+        label_char = _label_char(chr(code))
+        self[code] = label_char
+        return label_char
+
+
+_LABEL_TRANSLATION_TABLE = _LabelTranslationTable(
+    (code, _label_char(chr(code))) for code in range(0x250))
+
+
+@lru_cache(maxsize=4096)
 def title_to_label(tune_title: str) -> str:
     """
     Generate a tune label from a tune title
 
-    The label is obtained by converting the tune title to lower case
-    and then substituting all characters that are neither lower case ascii
-    characters nor digits to '_'
+    The label is obtained by converting the tune title to lower case,
+    removing the accents and then substituting all characters that are
+    neither lower case ascii characters nor digits to '_'
 
     Args:
         tune_title: The tune title, eg "Brid Harper's"
@@ -92,23 +200,7 @@ def title_to_label(tune_title: str) -> str:
     Returns:
         The tune label, eg 'brid_harper_s'
     """
-    label = ''
-    for c in tune_title.lower():
-        if not (c in string.ascii_lowercase or c in string.digits):
-            if c is 'í':
-                c = 'i'
-            elif c is 'ú':
-                c = 'u'
-            elif c is 'ó':
-                c = 'o'
-            elif c is 'ç':
-                c = 'c'
-            elif c is 'é' or c is 'è' or c is 'ê':
-                c = 'e'
-            else:
-                c = '_'
-        label += c
-    return label
+    return tune_title.lower().translate(_LABEL_TRANSLATION_TABLE)
 
 
 # ----------------------------------------------------------------------------
@@ -116,8 +208,9 @@ def title_to_label(tune_title: str) -> str:
 # ----------------------------------------------------------------------------
 
 class AbcError(Exception):
-    def __init__(self, free_text=''):
+    def __init__(self, free_text='', lineno=None):
         self._free_text = free_text
+        self.lineno = lineno  # Line of the error in the ABC file, if known
 
     def __str__(self):
         return self._free_text
@@ -132,7 +225,32 @@ class AbcParserStateMachineError(AbcError):
 
 
 class AbcParserStateMachine:
-    def __init__(self):
+    """
+    Parser of the tunes of an ABC file, fed line by line with run()
+
+    The parsing events (new tune, title, skipped lines, state transitions,
+    errors...) are logged at debug level, and written to the trace sink if
+    any, one JSON object per line, eg:
+
+        {"line": 12, "state": "WAIT_TITLE", "event": "title", "value": "Our
+        Kate"}
+
+    The debug level is checked once, when the parser is created: nothing is
+    done for the events if debug messages are off and there is no trace
+    sink, so as not to slow down the parsing of large files.
+
+    Args:
+        keep_text: if False, only record the byte offsets of the tunes in
+            the ABC file instead of their text (see
+            parse_abc_file(lazy=True))
+        trace: text file to write the trace of the parsing events to
+        source: name of the parsed file, for the trace
+        errors: if not None, the parser does not stop at the first
+            AbcError: the errors are appended to this list, and the tunes
+            in error are skipped
+    """
+    def __init__(self, keep_text=True, trace: Optional[TextIO] = None,
+                 source: str = None, errors: Optional[List[AbcError]] = None):
         self.S_WAIT_TUNE = 'WAIT_TUNE'
         self.S_WAIT_TITLE = 'WAIT_TITLE'
         self.S_READ_TUNE = 'READ_TUNE'
@@ -140,8 +258,19 @@ class AbcParserStateMachine:
 
         self._state = self.S_WAIT_TUNE
         self._lineno = 0
+        self._offset = None  # Byte offset of the current line in the file
+
+        self._keep_text = keep_text
+
+        self._trace = trace
+        self._source = source
+        self._debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # If False, the parsing events are ignored (see _trace_event)
+        self._tracing = self._debug or trace is not None
+        self._errors = errors
 
         self._tune = Tune()  # Tentative ABC tune being parsed
+        self._lines = []  # Text lines of the tentative tune
         self._tunes = []  # list of parsed Tune's
 
     def _parse_index(self, index_str: str) -> int:
@@ -162,70 +291,160 @@ class AbcParserStateMachine:
             return index
         except ValueError:
             raise AbcParserError('line {0}: invalid tune index string: \'{1}\''
-                                 .format(self._lineno, index_str))
+                                 .format(self._lineno, index_str),
+                                 self._lineno)
+
+    def _close_tune(self, end_offset=None):
+        """
+        Materialize the text of the tentative tune, add the tune to the list
+        of parsed tunes and start a new tentative tune.
+
+        The tune text is joined only once here rather than grown line by
+        line, so that parsing stays linear in the size of the tune.
+
+        Args:
+            end_offset: byte offset of the end of the tune in the ABC file,
+                only used when the parser does not keep the tune text
+        """
+        if self._keep_text:
+            self._tune.text = ''.join(self._lines)
+        else:
+            self._tune.text = None
+            self._tune.span = (self._tune.span[0], end_offset)
+        self._tunes.append(self._tune)
+        self._tune = Tune()
+        self._lines = []
+
+    def _trace_event(self, event: str, value):
+        """Log a parsing event and write it to the trace sink.  Only call
+        it if self._tracing."""
+        if self._debug:
+            logging.debug('AbcParserStateMachine: line %d: %s: %s',
+                          self._lineno, event, value)
+        if self._trace is not None:
+            record = {'line': self._lineno, 'state': self._state,
+                      'event': event, 'value': value}
+            if self._source is not None:
+                record['file'] = self._source
+            import json
+            self._trace.write(json.dumps(record) + '\n')
+
+    def _set_state(self, state: str):
+        if self._tracing:
+            self._trace_event('transition', state)
+        self._state = state
+
+    def _skip_tune(self):
+        """Drop the tentative tune, and wait for the next one"""
+        self._tune = Tune()
+        self._lines = []
+        self._set_state(self.S_WAIT_TUNE)
+
+    def _append_line(self, line):
+        if self._keep_text:
+            self._lines.append(line)
 
     def _run_with_index(self, stripped_line, line):
         self._tune.index = self._parse_index(stripped_line[2:])
-        self._tune.text += line
-        logging.debug('AbcParserStateMachine: new index: %d', self._tune.index)
-        self._state = self.S_WAIT_TITLE
+        if not self._keep_text:
+            self._tune.span = (self._offset, None)
+        self._append_line(line)
+        if self._tracing:
+            self._trace_event('index', self._tune.index)
+        self._set_state(self.S_WAIT_TITLE)
+
+    def needs_line_text(self) -> bool:
+        """Tell whether the next line must be given to run() even if it is
+        not a header line of the tune: the line following an index must be
+        a title, and the trace records every line."""
+        return self._tracing or self._state is self.S_WAIT_TITLE
+
+    def skip_lines(self, count: int):
+        """Feed the state machine with blank lines or lines of the body of a
+        tune, without their text.  Only valid if not needs_line_text()."""
+        self._lineno += count
+
+    def run(self, line, offset=None):
+        """Feed the state machine with the next line of the ABC file
 
-    def run(self, line):
+        Args:
+            line: text line, including the end of line character
+            offset: byte offset of the line in the ABC file, needed only when
+                the parser does not keep the tune text
+        """
         self._lineno += 1
+        self._offset = offset
 
         stripped_line = line.strip()
         if stripped_line == '':
             return
 
-        if self._state is self.S_WAIT_TUNE:
-            if stripped_line.startswith('X:'):
-                self._run_with_index(stripped_line, line)
-            else:
-                logging.debug('AbcParserStateMachine: skip heading line: %s',
-                              stripped_line)
-
-        elif self._state is self.S_WAIT_TITLE:
-            if stripped_line.startswith('T:'):
-                title = stripped_line[2:].strip()
-                if title is '':
-                    raise AbcParserError(
-                        'line {0}: empty title header field'
-                        .format(self._lineno))
-                self._tune.set_title(title)
-                self._tune.text += line
-                logging.debug('AbcParserStateMachine: title: %s',
-                              self._tune.title)
-                self._state = self.S_READ_TUNE
-            else:
-                raise AbcParserStateMachineError(
-                    'line {0}: tune index not followed by title: \'{1}\''
-                    .format(self._lineno, stripped_line))
-
-        elif self._state is self.S_READ_TUNE:
-            if stripped_line.startswith('X:'):  # New tune
-                self._tunes.append(self._tune)
-                self._tune = Tune()
-                self._run_with_index(stripped_line, line)
-            elif stripped_line.startswith('R:'):  # Header: tune type
-                self._tune.type = stripped_line[2:].strip()
-                self._tune.text += line
-                logging.debug('AbcParserStateMachine: type: %s',
-                              self._tune.type)
-            else:
-                self._tune.text += line
-                logging.debug('AbcParserStateMachine: new line: %s',
-                              line.strip('\n'))
-
-    def get_tunes(self) -> List[Tune]:
+        try:
+            if self._state is self.S_WAIT_TUNE:
+                if stripped_line.startswith('X:'):
+                    self._run_with_index(stripped_line, line)
+                elif self._tracing:
+                    self._trace_event('skip', stripped_line)
+
+            elif self._state is self.S_WAIT_TITLE:
+                if stripped_line.startswith('T:'):
+                    title = stripped_line[2:].strip()
+                    if title == '':
+                        raise AbcParserError(
+                            'line {0}: empty title header field'
+                            .format(self._lineno), self._lineno)
+                    self._tune.set_title(title)
+                    self._append_line(line)
+                    if self._tracing:
+                        self._trace_event('title', self._tune.title)
+                    self._set_state(self.S_READ_TUNE)
+                else:
+                    raise AbcParserStateMachineError(
+                        'line {0}: tune index not followed by title: \'{1}\''
+                        .format(self._lineno, stripped_line), self._lineno)
+
+            elif self._state is self.S_READ_TUNE:
+                if stripped_line.startswith('X:'):  # New tune
+                    self._close_tune(end_offset=offset)
+                    self._run_with_index(stripped_line, line)
+                elif stripped_line.startswith('R:'):  # Header: tune type
+                    # Few different tune types: share the strings
+                    self._tune.type = sys.intern(stripped_line[2:].strip())
+                    self._append_line(line)
+                    if self._tracing:
+                        self._trace_event('type', self._tune.type)
+                else:
+                    self._append_line(line)
+                    if self._tracing:
+                        self._trace_event('line', line.rstrip('\n'))
+        except AbcError as e:
+            if self._tracing:
+                self._trace_event('error', str(e))
+            if self._errors is None:
+                raise
+            self._errors.append(e)
+            new_tune = self._state is self.S_WAIT_TITLE and \
+                stripped_line.startswith('X:')
+            self._skip_tune()
+            if new_tune:
+                # The line is not the title of the skipped tune, but the
+                # start of the next one
+                self._lineno -= 1
+                self.run(line, offset)
+
+    def get_tunes(self, end_offset=None) -> List[Tune]:
         """Get the list of parsed tunes and stop the state machine
 
+        Args:
+            end_offset: size of the ABC file in bytes, needed only when the
+                parser does not keep the tune text
+
         Returns:
             A list of Tune objects
         """
         if self._tune.title is not None:
-            self._tunes.append(self._tune)
-            self._tune = Tune()
-        self._state = self.S_END
+            self._close_tune(end_offset=end_offset)
+        self._set_state(self.S_END)
         return self._tunes
 
 
@@ -233,29 +452,164 @@ class AbcParserStateMachine:
 # Easy-to-use parse function
 # ------------------------------------------------------------------------
 
-def parse_abc_file(abc_filepath: Path) -> List[Tune]:
+def parse_abc_file(abc_filepath: Path, lazy=False,
+                   trace: Optional[TextIO] = None) -> List[Tune]:
+    """Parse an ABC file and return a list of tunes.  Exit the program
+    if the file cannot be parsed.
+
+    Args: see read_abc_file()
+
+    Returns:
+        A list of Tune objects
+    """
+    try:
+        return read_abc_file(abc_filepath, lazy, trace)
+    except AbcError:
+        logging.error('Failed to parse ABC file: %s',
+                      str(abc_filepath), exc_info=True)
+        sys.exit(1)
+
+
+def read_abc_file(abc_filepath: Path, lazy=False,
+                  trace: Optional[TextIO] = None,
+                  errors: Optional[List[AbcError]] = None,
+                  digest=None,
+                  tune_digests: Optional[List[str]] = None) -> List[Tune]:
     """Parse an ABC file and return a list of tunes
 
     Args:
         abc_filepath: path to a text file containing one or several tunes
             in ABC notation format.
+        lazy: if True, memory-map the file and only record the headers and
+            the byte offsets of each tune: the text of a tune is read
+            from the file the first time Tune.text is accessed.  Use it when
+            only the tune metadata (title, label, type...) is needed.
+        trace: if not None, text file to write the trace of the parsing
+            events to, in JSON lines format (see AbcParserStateMachine)
+        errors: if not None, the errors are appended to this list instead
+            of being raised, and the tunes in error are skipped
+        digest: if not None, hashlib object to update with the content of
+            the file, so that the file needs not be read again to hash it.
+            Only with lazy=True.
+        tune_digests: if not None, the SHA-1 hex digest of the bytes of
+            each tune (see Tune.span) is appended to this list, in file
+            order.  Only with lazy=True.
 
     Returns:
         A list of Tune objects
 
+    Raises:
+        AbcError if the file is not a valid ABC file and errors is None
     """
-    parser = AbcParserStateMachine()
-    with open(abc_filepath, 'r') as f:
-        logging.debug('Parsing ABC file: %s', abc_filepath)
-        for line in f:
-            try:
+    if (digest is not None or tune_digests is not None) and not lazy:
+        raise ValueError('The digests of an ABC file are only computed by '
+                         'lazy parsing')
+    parser = AbcParserStateMachine(keep_text=not lazy, trace=trace,
+                                   source=str(abc_filepath), errors=errors)
+    logging.debug('Parsing ABC file: %s', abc_filepath)
+    if lazy:
+        tunes = _run_parser_on_mapped_file(parser, abc_filepath, digest,
+                                           tune_digests)
+    else:
+        with open(abc_filepath, 'r') as f:
+            for line in f:
                 parser.run(line)
-            except AbcError:
-                logging.error('Failed to parse ABC file: %s',
-                              str(abc_filepath), exc_info=True)
-                sys.exit(1)
-    tunes = parser.get_tunes()
+        tunes = parser.get_tunes()
+
     for tune in tunes:
         tune.path = abc_filepath
 
     return tunes
+
+
+def validate_abc_file(abc_filepath: Path) -> Tuple[List[Tune], List[AbcError]]:
+    """Parse a whole ABC file, even if it has errors, to find all of them
+    at once
+
+    Returns:
+        A tuple (valid tunes, errors).  The tunes are parsed as with
+        read_abc_file(lazy=True).  The errors have the line number of the
+        error in their 'lineno' attribute.
+    """
+    errors = []
+    tunes = read_abc_file(abc_filepath, lazy=True, errors=errors)
+    return tunes, errors
+
+
+# Lines of an ABC file that the parser reads in lazy mode
+_HEADER_PREFIXES = (b'X:', b'T:', b'R:')
+
+
+def _run_parser_on_mapped_file(parser: AbcParserStateMachine,
+                               abc_filepath: Path, digest=None,
+                               tune_digests: Optional[List[str]] = None) \
+        -> List[Tune]:
+    """Feed the parser with the header lines of a memory-mapped ABC file
+
+    The lines are scanned on the raw bytes: only the header lines read by
+    the parser (_HEADER_PREFIXES) are decoded, so that no string is made of
+    the lines of the tune bodies (see AbcParserStateMachine.skip_lines).
+    If digest is not None, it is updated with the mapped file.  If
+    tune_digests is not None, the SHA-1 of the bytes of each tune is
+    appended to it.
+
+    Returns:
+        The tunes found by the parser
+    """
+    import mmap
+    encoding = locale.getpreferredencoding(False)
+    with open(abc_filepath, 'rb') as f:
+        try:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files cannot be mapped
+            return parser.get_tunes(end_offset=0)
+        with mapped_file:
+            offset = 0
+            skipped = 0  # Lines skipped since the last line given to run()
+            needs_text = parser.needs_line_text()
+            for raw_line in iter(mapped_file.readline, b''):
+                if not (needs_text or
+                        raw_line.startswith(_HEADER_PREFIXES) or
+                        # Indented line: the only case where a copy is made
+                        (raw_line[:1].isspace() and
+                         raw_line.lstrip().startswith(_HEADER_PREFIXES))) \
+                        or raw_line.isspace():
+                    skipped += 1
+                else:
+                    parser.skip_lines(skipped)
+                    skipped = 0
+                    parser.run(raw_line.decode(encoding), offset)
+                    needs_text = parser.needs_line_text()
+                offset += len(raw_line)
+            parser.skip_lines(skipped)
+            tunes = parser.get_tunes(end_offset=offset)
+            if digest is not None:
+                digest.update(mapped_file)
+            if tune_digests is not None:
+                import hashlib
+                tune_digests.extend(
+                    hashlib.sha1(mapped_file[start:end]).hexdigest()
+                    for start, end in (tune.span for tune in tunes))
+            return tunes
+
+
+def read_tune_text(abc_filepath: Path, span: Tuple[int, int]) -> str:
+    """Read the text of a tune from an ABC file
+
+    The text is the same as the one gathered by the parser: the lines of
+    the file between the given offsets, without the blank lines.
+
+    Args:
+        abc_filepath: path to the ABC file containing the tune
+        span: (start, end) byte offsets of the tune in the file
+
+    Returns:
+        The ABC text of the tune
+    """
+    start, end = span
+    with open(abc_filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = io.StringIO(data.decode(locale.getpreferredencoding(False)),
+                        newline=None)
+    return ''.join(line for line in lines if line.strip() != '')
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Content-addressed cache of build artifacts
+
+The cache stores files under a key computed from everything their content
+depends on (eg the ABC text of a tune and the version of the converter),
+not from file names or modification times.  It can therefore be shared by
+several tunebooks on the same machine, and survives a git checkout that
+touches all the tune files.
+
+The cache size is bounded: when it grows beyond its maximum size, the
+least recently used files are removed.  Files are written atomically, so
+several builds can use the same cache at the same time.
+
+The engraved snippets written by lilypond-book in its output directory
+(--lily-output-dir) are bounded the same way, see evict_snippets().
+"""
+
+# Imports from the Python Standard Library:
+import hashlib
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+from typing import List, Tuple, Union
+
+
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024  # bytes
+
+# lilypond-book writes the files of a snippet as
+# <output dir>/<2 hex digits>/lily-<hex digits>[-<suffix>].<extension>
+_SNIPPET_RE = re.compile(r'([0-9a-f]{2})/(lily-[0-9a-f]+)')
+_SNIPPET_NAME_RE = re.compile(r'lily-[0-9a-f]+')
+
+
+def default_cache_dir() -> Path:
+    """Return the abcbook cache directory of the user, eg ~/.cache/abcbook"""
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    if xdg_cache_home:
+        return Path(xdg_cache_home) / 'abcbook'
+    return Path.home() / '.cache' / 'abcbook'
+
+
+class ArtifactCache:
+    """Files indexed by the hash of their inputs, with LRU eviction"""
+
+    def __init__(self, cache_dir: Path, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*inputs: Union[str, bytes]) -> str:
+        """Compute the cache key of an artifact from all its inputs"""
+        sha256 = hashlib.sha256()
+        for data in inputs:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            # Prefix each input with its length so that inputs cannot be
+            # confused when concatenated
+            sha256.update(str(len(data)).encode('ascii') + b':')
+            sha256.update(data)
+        return sha256.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key: str, dest: Path) -> bool:
+        """
+        Copy the artifact with the given key to dest, if it is in the cache
+
+        Returns:
+            True if the artifact was found in the cache
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(str(path), str(dest))
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(str(path))  # Most recently used
+        except OSError:  # Evicted in the meantime by another build
+            pass
+        logging.debug('Artifact cache hit: %s => %s', key, dest)
+        return True
+
+    def put(self, key: str, src: Path):
+        """Store a copy of the file src in the cache under the given key"""
+        path = self._path(key)
+        os.makedirs(str(path.parent), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.',
+                                        suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f, open(src, 'rb') as src_file:
+                shutil.copyfileobj(src_file, f)
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self) -> int:
+        """Remove the least recently used artifacts until the cache size is
+        at most max_size
+
+        Returns:
+            The size of the cache after eviction, in bytes
+        """
+        entries = []  # (mtime, size, [path])
+        for subdir in _scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in _scandir(subdir.path):
+                if entry.name.startswith('.'):  # Temporary files
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, [entry.path]))
+        total_size = _evict(entries, self.max_size)
+        logging.debug('Artifact cache size: %d bytes', total_size)
+        return total_size
+
+
+def touch_snippets(snippet_dir: Path, tex_path: Path):
+    """
+    Mark the lilypond-book snippets used by a book as most recently used
+
+    lilypond-book does not touch the snippets it reuses, so the snippets
+    referenced by its output file are touched here for evict_snippets().
+
+    Args:
+        snippet_dir: output directory of lilypond-book (--lily-output-dir)
+        tex_path: file written by lilypond-book
+    """
+    with open(tex_path, 'r', errors='replace') as f:
+        snippets = set(_SNIPPET_RE.findall(f.read()))
+    for subdir, name in snippets:
+        for entry in _scandir(snippet_dir / subdir):
+            m = _SNIPPET_NAME_RE.match(entry.name)
+            if m is not None and m.group() == name:
+                try:
+                    os.utime(entry.path)
+                except OSError:
+                    pass
+
+
+def evict_snippets(snippet_dir: Path, max_size: int) -> int:
+    """
+    Remove the least recently used lilypond-book snippets until the size of
+    the lilypond-book output directory is at most max_size.
+
+    All the files of a snippet (.ly, .tex, images...) are removed together,
+    so that lilypond-book engraves the snippet again instead of using an
+    incomplete one.
+
+    Returns:
+        The size of the directory after eviction, in bytes
+    """
+    snippets = {}  # (subdir, snippet name) => [mtime, size, [path]]
+    for subdir in _scandir(snippet_dir):
+        if not subdir.is_dir():
+            continue
+        for entry in _scandir(subdir.path):
+            m = _SNIPPET_NAME_RE.match(entry.name)
+            if m is None:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snippet = snippets.setdefault((subdir.name, m.group()),
+                                          [0, 0, []])
+            snippet[0] = max(snippet[0], stat.st_mtime)
+            snippet[1] += stat.st_size
+            snippet[2].append(entry.path)
+    total_size = _evict([tuple(snippet) for snippet in snippets.values()],
+                        max_size)
+    logging.debug('lilypond-book snippets size: %d bytes', total_size)
+    return total_size
+
+
+def _evict(entries: List[Tuple[float, int, List[str]]], max_size: int) -> int:
+    """Remove the files of the oldest entries (mtime, size, paths) until
+    their total size is at most max_size, and return the total size"""
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= max_size:
+        return total_size
+    entries.sort()
+    for _, size, paths in entries:
+        if total_size <= max_size:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total_size -= size
+    logging.info('Cache size after eviction: %d bytes', total_size)
+    return total_size
+
+
+def _scandir(path):
+    try:
+        return list(os.scandir(str(path)))
+    except OSError:
+        return []
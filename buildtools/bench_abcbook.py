@@ -0,0 +1,395 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Benchmarks of the abcbook build tools on synthetic tunebooks
+
+Generate tunebooks of various sizes (varied ABC header layouts, long tune
+bodies, many sets), then measure the time and the peak memory of the main
+steps of a build: parsing the ABC file, splitting it, generating the
+LilyPond book and its indexes.
+
+The results are compared with a baseline to find out whether a change
+makes the tools faster or slower.  By default, the baseline is
+bench_baseline.json, committed next to this script:
+
+    $ bench_abcbook.py
+
+Baselines depend on the machine, so they should only be compared with
+results obtained on the same machine.  Save a baseline of your own machine
+before changing the code:
+
+    $ bench_abcbook.py --save-baseline _build/bench_baseline.json
+    (change the code)
+    $ bench_abcbook.py --compare _build/bench_baseline.json
+
+The 100k-tune corpus takes several minutes: use eg '-s 1000,10000' for a
+quicker run.
+"""
+
+# Imports from the Python Standard Library:
+import argparse
+import gc
+import json
+import logging
+from pathlib import Path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Imports from the project library:
+from abcparser import parse_abc_file
+from abcsplit import split_abc_file
+from gen_tex_tunebook import (TuneRegistry, gen_book, gen_index_of_sets,
+                              gen_index_of_tunes)
+
+
+# ------------------------------------------------------------------------
+# Global variables
+# ------------------------------------------------------------------------
+
+RESULTS_FORMAT_VERSION = 1
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_BASELINE = Path(__file__).parent / 'bench_baseline.json'
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.25  # Relative slow down reported as a regression
+
+ARGS = None
+
+
+# ------------------------------------------------------------------------
+#     Synthetic tunebooks
+# ------------------------------------------------------------------------
+
+WORDS = ['The', 'Humours', 'of', 'Ballylaughlin', 'Paddy', "Fahy's",
+         'Ó', 'Raghallaigh', 'Ridées', 'Lanvaudan', 'Kitty', 'Lie', 'Over',
+         'Monaghan', 'Twig', 'Crock', 'Gold', 'An', 'Dro', 'à', 'Gwened',
+         'Mountain', 'Road', 'Old', 'Bush', "Kate's", 'Ñandú', 'Éire']
+TUNE_TYPES = ['reel', 'jig', 'slip jig', 'hornpipe', 'polka', 'slide',
+              'an dro', 'gavotte', 'slow air', 'waltz']
+BARS = ['|: "G" B2dB BAGE | "Am" GGGA GED2 | "D" DEGA "G" BGGG |',
+        '|: AFD DFA | Add ABA | ABA FFF | GFG EFG |',
+        '| cAAB cded | cAAG E2ed | cAAB cded | e2a2 ag e2 :|',
+        '|1 fed B2A | AdF G2B | ABA F2E | EDD D2e :|2 EDD d2B |']
+
+TEMPLATE = ('\\documentclass{book}\n'
+            '\\begin{document}\n'
+            '%%INSERT_TUNES\n'
+            '%%INSERT_INDEX\n'
+            '\\end{document}\n')
+
+
+def gen_abc_tune(rng: random.Random, index: int) -> str:
+    """Generate a tune with a random header layout and body length"""
+    title = ' '.join(rng.sample(WORDS, rng.randint(2, 5)))
+    title += ' ' + str(index)  # Tune labels must be unique
+    fields = ['C:Trad.', 'R:' + rng.choice(TUNE_TYPES).title(),
+              'S:Session au pub', 'M:4/4', 'L:1/8', 'Q:120']
+    rng.shuffle(fields)
+    fields = fields[:rng.randint(1, len(fields))]
+    if rng.random() < 0.2:
+        fields.insert(rng.randint(0, len(fields)), '% comment')
+    lines = ['X:' + str(index), 'T:' + title]
+    if rng.random() < 0.2:
+        lines.append('T:Second title ' + str(index))
+    lines += fields
+    lines.append('K:' + rng.choice(['G', 'D', 'Amix', 'Edor']))
+    for _ in range(rng.choice([4, 8, 16, 64])):  # Some tunes are long
+        lines.append(rng.choice(BARS))
+    return '\n'.join(lines) + '\n'
+
+
+def gen_corpus(directory: Path, nb_of_tunes: int, seed: int = 0) -> Path:
+    """
+    Generate a synthetic tunebook directory: a multi-tune ABC file, the list
+    of tune files, the list of sets and a template.
+
+    Args:
+        directory: directory of the tunebook, created if needed
+
+        nb_of_tunes: number of tunes in the ABC file
+
+        seed: random seed, so that the same corpus is generated each time
+
+    Returns:
+        The path of the ABC file
+    """
+    rng = random.Random(seed)
+    bookspecs = directory / 'bookspecs'
+    bookspecs.mkdir(parents=True, exist_ok=True)
+
+    abc_path = directory / 'tunebook.abc'
+    with open(abc_path, 'w') as f:
+        f.write('% Synthetic tunebook\n\n')
+        for index in range(1, nb_of_tunes + 1):
+            f.write(gen_abc_tune(rng, index))
+            f.write('\n')
+
+    tunes = parse_abc_file(abc_path, lazy=True)
+    labels = [tune.label for tune in tunes]
+    with open(bookspecs / 'tune_sets.txt', 'w') as f:
+        f.write('# Synthetic sets\n')
+        for set_index in range(nb_of_tunes // 3):
+            set_labels = rng.sample(labels, min(len(labels),
+                                                rng.randint(2, 4)))
+            if rng.random() < 0.3:
+                f.write('Set {}: '.format(set_index))
+            f.write(', '.join(set_labels) + '\n')
+
+    (bookspecs / 'tune_files.txt').write_text(str(abc_path) + '\n')
+    (bookspecs / 'book_template.tex').write_text(TEMPLATE)
+    return abc_path
+
+
+# ------------------------------------------------------------------------
+#     Measures
+# ------------------------------------------------------------------------
+
+def measure(func: Callable[[], None], setup: Callable[[], None] = None,
+            repeat: int = DEFAULT_REPEAT) -> Dict[str, float]:
+    """
+    Measure the time and the peak memory of a function.
+
+    Args:
+        func: function to measure
+
+        setup: if not None, function called before each call of func,
+            not measured
+
+        repeat: number of timed calls of func: the fastest one is kept
+
+    Returns:
+        A dict with the 'seconds' and the 'peak_memory_kb' used by func
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc slows everything down: memory is measured separately
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_memory_kb': peak // 1024}
+
+
+def run_benchmarks(directory: Path, nb_of_tunes: int,
+                   repeat: int = DEFAULT_REPEAT) -> Dict[str, dict]:
+    """
+    Generate a corpus of nb_of_tunes tunes in directory and run all the
+    benchmarks on it.
+
+    Returns:
+        benchmark name => measures (see measure()), with the throughput
+        in 'tunes_per_second'
+    """
+    abc_path = gen_corpus(directory, nb_of_tunes)
+    split_dir = directory / 'splitabc'
+    bookspecs = directory / 'bookspecs'
+    book_dir = directory / '_build' / 'out.stage1'
+    book_dir.mkdir(parents=True, exist_ok=True)
+
+    def remove_split_dir():
+        shutil.rmtree(str(split_dir), ignore_errors=True)
+
+    tunes = TuneRegistry(parse_abc_file(abc_path, lazy=True))
+
+    benchmarks = [
+        ('parse_abc_file', lambda: parse_abc_file(abc_path), None),
+        ('parse_abc_file_lazy', lambda: parse_abc_file(abc_path, lazy=True),
+         None),
+        ('split_abc_file', lambda: split_abc_file(abc_path, split_dir),
+         remove_split_dir),
+        ('split_abc_file_unchanged',
+         lambda: split_abc_file(abc_path, split_dir), None),
+        ('gen_book',
+         lambda: gen_book(book_dir / 'tunebook.lytex',
+                          bookspecs / 'tune_files.txt',
+                          template_path=bookspecs / 'book_template.tex',
+                          tune_sets_path=bookspecs / 'tune_sets.txt'), None),
+        ('gen_index_of_tunes', lambda: ''.join(gen_index_of_tunes(tunes)),
+         None),
+        ('gen_index_of_sets',
+         lambda: gen_index_of_sets(str(bookspecs / 'tune_sets.txt'), tunes),
+         None),
+    ]
+
+    results = {}
+    for name, func, setup in benchmarks:
+        if ARGS is not None and ARGS.only and name not in ARGS.only:
+            continue
+        logging.info('%d tunes: %s', nb_of_tunes, name)
+        result = measure(func, setup, repeat)
+        result['tunes_per_second'] = nb_of_tunes / result['seconds']
+        results[name] = result
+    return results
+
+
+# ------------------------------------------------------------------------
+#     Results and baselines
+# ------------------------------------------------------------------------
+
+def gen_results(sizes: List[int], repeat: int = DEFAULT_REPEAT,
+                work_dir: Path = None) -> dict:
+    """Run the benchmarks for each corpus size"""
+    results = {'version': RESULTS_FORMAT_VERSION,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'sizes': {}}
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for nb_of_tunes in sizes:
+            directory = Path(tmp_dir) / str(nb_of_tunes)
+            results['sizes'][str(nb_of_tunes)] = \
+                run_benchmarks(directory, nb_of_tunes, repeat)
+            shutil.rmtree(str(directory))
+    return results
+
+
+def compare_results(baseline: dict, results: dict,
+                    threshold: float = DEFAULT_THRESHOLD) \
+        -> Tuple[List[str], bool]:
+    """
+    Compare benchmark results with a baseline.
+
+    Args:
+        baseline: results of a previous run
+
+        results: results of the current run
+
+        threshold: relative slow down above which a benchmark is reported
+            as a regression (eg 0.1: 10% slower)
+
+    Returns:
+        A tuple (report lines, True if there is at least one regression)
+    """
+    lines = ['{:>7} {:<26} {:>11} {:>11} {:>7} {:>9}'.format(
+        'tunes', 'benchmark', 'baseline', 'current', 'ratio', 'memory')]
+    regression = False
+    for size, benchmarks in sorted(results['sizes'].items(),
+                                   key=lambda item: int(item[0])):
+        for name, current in benchmarks.items():
+            base = baseline.get('sizes', {}).get(size, {}).get(name)
+            if base is None:
+                lines.append('{:>7} {:<26} {:>11} {:>9.1f}ms'.format(
+                    size, name, '-', current['seconds'] * 1000))
+                continue
+            ratio = current['seconds'] / base['seconds']
+            memory_ratio = (current['peak_memory_kb'] /
+                            max(base['peak_memory_kb'], 1))
+            status = ''
+            if ratio > 1 + threshold or memory_ratio > 1 + threshold:
+                status = '  SLOWER' if ratio > 1 + threshold else '  MEMORY'
+                regression = True
+            elif ratio < 1 - threshold:
+                status = '  faster'
+            lines.append('{:>7} {:<26} {:>9.1f}ms {:>9.1f}ms {:>6.2f}x '
+                         '{:>8.2f}x{}'.format(size, name,
+                                              base['seconds'] * 1000,
+                                              current['seconds'] * 1000,
+                                              ratio, memory_ratio, status))
+    return lines, regression
+
+
+def format_results(results: dict) -> List[str]:
+    """Format benchmark results as a table"""
+    lines = ['{:>7} {:<26} {:>11} {:>14} {:>11}'.format(
+        'tunes', 'benchmark', 'time', 'tunes/s', 'memory')]
+    for size, benchmarks in sorted(results['sizes'].items(),
+                                   key=lambda item: int(item[0])):
+        for name, result in benchmarks.items():
+            lines.append('{:>7} {:<26} {:>9.1f}ms {:>14.0f} {:>9}kB'.format(
+                size, name, result['seconds'] * 1000,
+                result['tunes_per_second'], result['peak_memory_kb']))
+    return lines
+
+
+# ----------------------------------------------------------------------------
+#     Entry point & CLI arguments parsing
+# ----------------------------------------------------------------------------
+
+def main(argv: Optional[List[str]] = None) -> int:
+    global ARGS
+    ARGS = parse_command_line(argv)
+    setup_logging()
+
+    # Read before --save-baseline may overwrite it
+    baseline = None
+    if ARGS.compare:
+        with open(ARGS.compare, 'r') as f:
+            baseline = json.load(f)
+
+    results = gen_results(ARGS.sizes, ARGS.repeat)
+
+    if ARGS.save_baseline:
+        with open(ARGS.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+    if baseline is not None:
+        lines, regression = compare_results(baseline, results,
+                                            ARGS.threshold)
+        print('\n'.join(lines))
+        if regression:
+            print('Regression above {:.0%} found'.format(ARGS.threshold))
+            return 1
+    else:
+        print('\n'.join(format_results(results)))
+    return 0
+
+
+def parse_command_line(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the abcbook tools on synthetic tunebooks')
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES,
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated numbers of tunes of the '
+                             'synthetic tunebooks (default: {})'.format(
+                                 ','.join(str(n) for n in DEFAULT_SIZES)))
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of runs of each benchmark: the fastest '
+                             'one is kept')
+    parser.add_argument('--only', action='append',
+                        help='only run this benchmark (can be repeated)')
+    parser.add_argument('--save-baseline', metavar='PATH',
+                        help='save the results to a JSON file')
+    parser.add_argument('--compare', metavar='PATH',
+                        default=str(DEFAULT_BASELINE),
+                        help='compare the results with a baseline saved by '
+                             '--save-baseline, and exit with status 1 if a '
+                             'benchmark is slower (default: {})'.format(
+                                 DEFAULT_BASELINE.name))
+    parser.add_argument('--no-compare', dest='compare', action='store_const',
+                        const=None,
+                        help='only print the results, without comparing '
+                             'them with a baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slow down reported as a regression '
+                             '(default: {})'.format(DEFAULT_THRESHOLD))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show progress messages')
+    return parser.parse_args(argv)
+
+
+def setup_logging():
+    # Warnings of the measured tools would only add noise
+    logging_level = logging.INFO if ARGS.verbose else logging.ERROR
+    logging.basicConfig(level=logging_level, format='<%(levelname)s> %(message)s')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,15 +2,27 @@
 # -*- coding:utf-8 -*-
 
 # Imports from the Python Standard Library:
+# Note: this script is run by make for each tunebook, so the modules which
+# are slow to import and only used by some options or on some paths
+# (concurrent.futures, hashlib, watcher) are imported where they are used.
+import filecmp
+import io
+import json
 import logging
+import os
 from optparse import OptionParser
 from pathlib import Path
-import re
 import sys
-from typing import List
+import time
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional,
+                    TextIO, Tuple, Union)
 
 # Imports from the project library:
-from abcparser import Tune, parse_abc_file
+from abcparser import AbcError, Tune, read_abc_file
+from lyheader import LilypondHeader, scan_lilypond_header
+from timings import Timings
+from tunecache import (DEFAULT_CACHE_PATH, TuneMetadataCache, file_sha1,
+                       read_with_fingerprint, update_digest)
 
 
 # ------------------------------------------------------------------------
@@ -18,48 +30,145 @@ from abcparser import Tune, parse_abc_file
 # ------------------------------------------------------------------------
 
 TUNE_SETS_FILENAME = 'bookspecs/tune_sets.txt'
+TEMPLATE_FILENAME = 'bookspecs/book_template.tex'
+OUTPUT_DIR = '_build/out.stage1'
+
+# Template tags
+INSERT_TUNES_TAG = '%%INSERT_TUNES'
+INSERT_INDEX_TAG = '%%INSERT_INDEX'
+
+# Possible groupings of the index of tunes (see gen_index_of_tunes)
+INDEX_GROUPS = ['letter', 'type']
 
 CLI_OPTIONS = None
 CLI_ARGS = None
 
+# Time spent in each stage of the generation (see --profile, --timings-json)
+TIMINGS = Timings()
+
 
 # ----------------------------------------------------------------------------
 #     Entry point & CLI arguments parsing
 # ----------------------------------------------------------------------------
 
-def main():
+def main(argv: Optional[List[str]] = None):
+    """Entry point.  argv are the command line arguments, sys.argv[1:] if
+    None."""
     global CLI_OPTIONS
     global CLI_ARGS
 
-    (CLI_OPTIONS, CLI_ARGS) = parse_command_line()
+    (CLI_OPTIONS, CLI_ARGS) = parse_command_line(argv)
     setup_logging()
+    TIMINGS.reset()
+
+    cache = None
+    if not CLI_OPTIONS.no_cache:
+        cache = TuneMetadataCache(Path(CLI_OPTIONS.cache_file))
+        if CLI_OPTIONS.clear_cache:
+            cache.clear()
+        else:
+            cache.load()
+    elif CLI_OPTIONS.watch:
+        # Keep the tunes in memory between two generations, without
+        # reading or writing the cache file
+        cache = TuneMetadataCache(Path(CLI_OPTIONS.cache_file))
 
     book_path = Path(CLI_OPTIONS.output_dir)
     book_path = book_path.joinpath(CLI_OPTIONS.bookname + '.lytex')
-    gen_book(book_path, Path(CLI_OPTIONS.tune_file_list))
+    manifest_path = None
+    if not CLI_OPTIONS.no_deps_manifest:
+        manifest_path = book_path.with_suffix('.deps.json')
+    book_options = {
+        'cache': cache,
+        'jobs': CLI_OPTIONS.jobs,
+        'manifest_path': manifest_path,
+        'template_path': Path(CLI_OPTIONS.template),
+        'tune_sets_path': Path(CLI_OPTIONS.tune_sets),
+        'lilypond_dir': CLI_OPTIONS.output_dir,
+        'index_group_by': CLI_OPTIONS.index_group_by,
+    }
+    if CLI_OPTIONS.watch:
+        try:
+            watch_book(book_path, Path(CLI_OPTIONS.tune_file_list),
+                       **book_options)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    try:
+        gen_book(book_path, Path(CLI_OPTIONS.tune_file_list), **book_options)
+    except TunebookError as e:
+        logging.error('%s', e)
+        sys.exit(1)
+
+    if cache is not None and not CLI_OPTIONS.no_cache:
+        with TIMINGS.stage('cache_save'):
+            cache.save()
+    report_timings()
 
 
-def parse_command_line():
+def report_timings():
+    """Output the timings of the generation, as requested by --profile and
+    --timings-json"""
+    if CLI_OPTIONS.profile:
+        TIMINGS.print_report()
+    if CLI_OPTIONS.timings_json:
+        TIMINGS.write_json(Path(CLI_OPTIONS.timings_json))
+
+
+def parse_command_line(argv: Optional[List[str]] = None):
     parser = OptionParser()
     parser.add_option('-b', '--bookname', dest='bookname', default='tunebook',
                       help='set the tunebook name')
     parser.add_option('-o', '--output-dir', dest='output_dir', type=str,
-                      default='_build/out.stage1',
+                      default=OUTPUT_DIR,
                       help='directory to write the lilypond book '
                            'and read the lilypond files')
     parser.add_option('-t', '--template', dest='template', type=str,
-                      default='bookspecs/book_template.tex',
+                      default=TEMPLATE_FILENAME,
                       help='path to the tunebook TeX template file')
+    parser.add_option('-s', '--tune-sets', dest='tune_sets', type=str,
+                      default=TUNE_SETS_FILENAME,
+                      help='path to the file with the list of tune sets')
     parser.add_option('-f', '--tune-file-list', dest='tune_file_list', type=str,
                       default='bookspecs/tune_files.txt',
                       help='path to the file with the list of ABC and lilypond '
                            'files to add to the book.')
+    parser.add_option('--index-group-by', dest='index_group_by',
+                      type='choice', choices=INDEX_GROUPS,
+                      help='group the tunes of the index by initial letter '
+                           'or by tune type: ' + ', '.join(INDEX_GROUPS))
+    parser.add_option('--cache-file', dest='cache_file', type=str,
+                      default=DEFAULT_CACHE_PATH,
+                      help='path to the cache of tune metadata')
+    parser.add_option('--no-cache', dest='no_cache', action='store_true',
+                      help='do not use the cache of tune metadata')
+    parser.add_option('--clear-cache', dest='clear_cache', action='store_true',
+                      help='invalidate the cache of tune metadata before '
+                           'generating the book')
+    parser.add_option('--no-deps-manifest', dest='no_deps_manifest',
+                      action='store_true',
+                      help='do not write the dependency manifest of the '
+                           'tunebook (<bookname>.deps.json)')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true',
+                      help='keep running and generate the tunebook again '
+                           'each time one of its input files changes')
+    parser.add_option('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='number of tune files to parse in parallel')
+    parser.add_option('--profile', dest='profile', action='store_true',
+                      help='print the time spent in each stage of the '
+                           'generation, and the slowest tune files')
+    parser.add_option('--timings-json', dest='timings_json', type=str,
+                      metavar='PATH',
+                      help='write the time spent in each stage of the '
+                           'generation, the parse time of each tune file '
+                           'and the peak memory usage to a JSON file')
     parser.add_option('-d', '--debug',
                       help='show debug messages',
                       action='store_true')
     parser.add_option('-v', '--verbose', action='store_true',
                         help='verbosity level')
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
     return options, args
 
 
@@ -73,13 +182,141 @@ def setup_logging():
     logging.basicConfig(level=logging_level, format='<%(levelname)s> %(message)s')
 
 
+# ------------------------------------------------------------------------
+#     Tunebook builder
+# ------------------------------------------------------------------------
+
+class TunebookError(Exception):
+    """Error that prevents the generation of a tunebook"""
+
+
+class TunebookBuilder:
+    """
+    Generate the LilyPond book (LaTeX) text of a tunebook, in memory.
+
+    A builder does not depend on the command line options, on the current
+    directory or on any other global state, and reports errors by raising
+    TunebookError: a single builder can generate several tunebooks at the
+    same time, eg in the threads of a server.
+
+    Args:
+        template: text of the tunebook TeX template, or its lines
+
+        lilypond_dir: directory of the LilyPond files of the tunes (see
+            lilypond_include_path)
+
+        index_group_by: grouping of the index of tunes (see
+            gen_index_of_tunes)
+    """
+    def __init__(self, template: Union[str, Iterable[str]],
+                 lilypond_dir: str = OUTPUT_DIR,
+                 index_group_by: Optional[str] = None):
+        self.template = template
+        self.template_path = None
+        self.lilypond_dir = lilypond_dir
+        self.index_group_by = index_group_by
+
+    @classmethod
+    def from_template_file(cls, template_path: Path,
+                           **kwargs) -> 'TunebookBuilder':
+        """
+        Create a builder using the template of a file.  The file is read
+        line by line, each time a tunebook is generated.
+
+        Raises:
+            OSError if the template file cannot be read
+        """
+        # Fail now rather than in the middle of the first tunebook
+        open(template_path, 'r').close()
+        builder = cls((), **kwargs)
+        builder.template_path = template_path
+        return builder
+
+    def template_lines(self) -> Iterator[str]:
+        """Return an iterator over the lines of the template"""
+        if self.template_path is not None:
+            with open(self.template_path, 'r') as f:
+                yield from f
+        elif isinstance(self.template, str):
+            yield from io.StringIO(self.template)
+        else:
+            yield from self.template
+
+    def stream(self, tunes: Iterable[Tune],
+               tune_sets: Optional[Iterable[str]] = None,
+               sets_name: str = '<tune sets>',
+               timings: Timings = None) -> Iterator[str]:
+        """
+        Generate a tunebook, piece by piece.
+
+        Args:
+            tunes: tunes of the tunebook, in tunebook order
+
+            tune_sets: lines of the list of sets, in the format of the
+                tune_sets.txt file, or None for no index of sets
+
+            sets_name: name of the list of sets in warnings
+
+            timings: if not None, record the time spent in each stage
+
+        Returns:
+            An iterator over the text of the tunebook
+
+        Raises:
+            TunebookError if two tunes have the same label.  The tunes are
+            checked before this method returns.
+        """
+        if timings is None:
+            timings = Timings()
+        registry = TuneRegistry()
+        with timings.stage('check_tunes'):
+            for tune in tunes:
+                assert_tune_uniqueness(new_tune=tune, tunes=registry)
+                registry.add(tune)
+        timings.count('tunes', len(registry))
+
+        def insert_tunes():
+            with timings.stage('emit_tunes'):
+                for tune in registry:
+                    yield from gen_tune(tune.label, tune.title, tune.type,
+                                        self.lilypond_dir)
+
+        def insert_index():
+            yield '\\twocolumn\n'
+            with timings.stage('index_of_tunes'):
+                yield from gen_index_of_tunes(registry,
+                                              self.index_group_by)
+            if tune_sets is not None:
+                with timings.stage('index_of_sets'):
+                    yield from gen_index_of_sets_from_lines(tune_sets,
+                                                            registry,
+                                                            sets_name)
+
+        return expand_template(self.template_lines(),
+                               [(INSERT_TUNES_TAG, insert_tunes),
+                                (INSERT_INDEX_TAG, insert_index)])
+
+    def build(self, tunes: Iterable[Tune],
+              tune_sets: Optional[Iterable[str]] = None,
+              **kwargs) -> str:
+        """Generate a tunebook and return its text.  See stream()"""
+        return ''.join(self.stream(tunes, tune_sets, **kwargs))
+
+
 # ------------------------------------------------------------------------
 #     Generate the book
 # ------------------------------------------------------------------------
 
-def gen_book(book_path: Path, tune_files_path: Path):
+def gen_book(book_path: Path, tune_files_path: Path,
+             cache: TuneMetadataCache = None, jobs: int = 1,
+             manifest_path: Path = None,
+             template_path: Path = Path(TEMPLATE_FILENAME),
+             tune_sets_path: Path = Path(TUNE_SETS_FILENAME),
+             lilypond_dir: str = OUTPUT_DIR,
+             index_group_by: Optional[str] = None):
     """
-    Generate a tunebook in LilyPond book format.
+    Generate a tunebook in LilyPond book format from the files of a
+    tunebook project.
 
     Args:
         book_path: path of the tunebook to be generated
@@ -87,75 +324,395 @@ def gen_book(book_path: Path, tune_files_path: Path):
         tune_files_path: path of the text file containing the list of
             tune files to be incorporated in the tunebook.
 
+        cache: if not None, cache of tune metadata used to avoid parsing
+            the tune files that did not change since the previous run.
+
+        jobs: number of tune files to parse in parallel
+
+        manifest_path: if not None, path of the dependency manifest to
+            write (see gen_deps_manifest)
+
+        template_path: path of the tunebook TeX template file
+
+        tune_sets_path: path of the file with the list of tune sets
+
+        lilypond_dir: directory of the LilyPond files of the tunes (see
+            lilypond_include_path)
+
+        index_group_by: grouping of the index of tunes (see
+            gen_index_of_tunes)
+
+    The tunebook and the manifest are left untouched if their content did
+    not change, so that the tools depending on them are not run again.
+
     Returns:
         None
+
+    Raises:
+        TunebookError if the tunebook cannot be generated
     """
 
-    tune_file_paths = read_tune_file_list(tune_files_path)
-
-    with open(CLI_OPTIONS.template, 'r') as f:
-        template = f.readlines()
-
-    with open(book_path, 'w') as f:
-        # Step 1: copy template lines until %%INSERT_TUNES to tunebook
-        f.writelines(eat_up_template(template, '%%INSERT_TUNES\n'))
-
-        # Step 2: insert tunes in tunebook
-        tunes = []  # List of Tune objects
-        for path in tune_file_paths:
-            new_tunes = []
-
-            if path.suffix == '.abc':
-                # Here we process each ABC file as if it contained
-                # several tunes, even if abcbook.mk can actually deal with
-                # only one multi-tune ABC file.
-                new_tunes = parse_abc_file(path)
-
-                if book_path.stem != path.stem:
-                    # We are not processing the main ABC file, so we should
-                    # have a single-tune abc file: we will
-                    # do a few checks to help troubleshooting when
-                    # lilypond-book fails.
-
-                    if len(new_tunes) == 0:
-                        logging.warning('No tune in ABC file: %s', path)
-                    elif len(new_tunes) == 1:
-                        if new_tunes[0].label != path.stem:
-                            logging.warning('ABC file name does not match '
-                                            'ABC tune title: %s', path)
-                            logging.warning('    (should be: %s)',
-                                            path.parent /
-                                            Path(new_tunes[0].label + '.abc'))
-                    else:
-                        logging.warning('More than one tune in ABC file: %s',
-                                        path)
-
-            elif path.suffix == '.ly':
-                title, tune_type = get_lilypond_tune_metadata(path)
-                new_tunes.append(Tune(title, tune_type, path=path))
+    with TIMINGS.stage('read_list'):
+        tune_file_paths = read_tune_file_list(tune_files_path)
+    with TIMINGS.stage('load_tunes'):
+        tunes_by_file = load_tune_files(tune_file_paths, cache, jobs,
+                                        timings=TIMINGS)
+
+    for path, new_tunes in zip(tune_file_paths, tunes_by_file):
+        if path.suffix == '.abc' and book_path.stem != path.stem:
+            # We are not processing the main ABC file, so we should
+            # have a single-tune abc file: we will
+            # do a few checks to help troubleshooting when
+            # lilypond-book fails.
+            check_single_tune_abc_file(path, new_tunes)
+    TIMINGS.count('tune_files', len(tune_file_paths))
+
+    try:
+        builder = TunebookBuilder.from_template_file(
+            template_path, lilypond_dir=lilypond_dir,
+            index_group_by=index_group_by)
+    except OSError as e:
+        raise TunebookError('Cannot read the template: {0}'.format(e))
+    tune_sets = read_tune_sets(tune_sets_path)
+
+    tunes = [tune for new_tunes in tunes_by_file for tune in new_tunes]
+    chunks = builder.stream(tunes, tune_sets, sets_name=str(tune_sets_path),
+                            timings=TIMINGS)
+    with TIMINGS.stage('template'):
+        changed = write_if_changed(book_path,
+                                   lambda f: f.writelines(chunks))
+    if not changed:
+        logging.info('Tunebook unchanged: %s', book_path)
+
+    if manifest_path is not None:
+        with TIMINGS.stage('deps_manifest'):
+            manifest = gen_deps_manifest(tunes, tune_files_path,
+                                         template_path, tune_sets_path,
+                                         lilypond_dir, cache)
+
+            def write_manifest(f: TextIO):
+                json.dump(manifest, f, indent=1)
+                f.write('\n')
+
+            write_if_changed(manifest_path, write_manifest)
+
+
+def write_if_changed(path: Path, write: Callable[[TextIO], None]) -> bool:
+    """
+    Write a file with a function, through a temporary file which replaces
+    the file only if the content changed (see replace_if_changed).  The
+    temporary file is removed if the function fails.
+
+    Args:
+        path: path of the file
+
+        write: function writing the content to the text file it is given
+
+    Returns:
+        True if the file was replaced
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    f = open(tmp_path, 'w')
+    try:
+        with f:
+            write(f)
+    except BaseException:
+        os.remove(str(tmp_path))
+        raise
+    return replace_if_changed(tmp_path, path)
+
+
+def replace_if_changed(tmp_path: Path, path: Path) -> bool:
+    """
+    Rename a newly written file to its final path, unless the file at this
+    path has the same content: in that case, the newly written file is
+    removed and the existing file is left untouched.
+
+    Returns:
+        True if the file was replaced
+    """
+    if path.exists() and filecmp.cmp(str(tmp_path), str(path), shallow=False):
+        os.remove(str(tmp_path))
+        return False
+    os.replace(str(tmp_path), str(path))
+    return True
+
+
+def gen_deps_manifest(tunes: Iterable[Tune], tune_files_path: Path,
+                      template_path: Path = Path(TEMPLATE_FILENAME),
+                      tune_sets_path: Path = Path(TUNE_SETS_FILENAME),
+                      lilypond_dir: str = OUTPUT_DIR,
+                      cache: TuneMetadataCache = None) -> dict:
+    """
+    Describe what the tunebook depends on, for make or an external build
+    driver.
+
+    Args:
+        tunes: tunes in the tunebook
+
+        tune_files_path: path of the text file containing the list of
+            tune files
+
+        template_path, tune_sets_path, lilypond_dir: see gen_book()
+
+        cache: if not None, cache of tune metadata which the tunes were
+            loaded with: the SHA-1 of the tune files and of the tunes are
+            taken from it instead of reading the files again
+
+    Returns:
+        A dict, to be written in JSON format, with:
+        - 'inputs': the files other than tune files that the tunebook
+          depends on (template, list of tune files, list of sets)
+        - 'sources': tune file path => SHA-1 of the file content
+        - 'tunes': for each tune, in tunebook order, its source file, its
+          label, the SHA-1 of its content (see
+          TuneMetadataCache.tune_sha1s) and the path of the LilyPond file
+          included in the tunebook
+    """
+    manifest = {
+        'inputs': [str(template_path), str(tune_files_path),
+                   str(tune_sets_path)],
+        'sources': {},
+        'tunes': [],
+    }
+    tunes = list(tunes)
+    spans = {}  # Tune file path => Tune.span of its tunes
+    for tune in tunes:
+        spans.setdefault(tune.path, []).append(tune.span)
+
+    # Each tune file is hashed once, whatever its number of tunes
+    sources = manifest['sources']
+    tune_sha1s = {}  # Tune file path => {Tune.span => SHA-1 of the tune}
+    for path, file_spans in spans.items():
+        if cache is not None:
+            sources[str(path)] = cache.sha1(path)
+            tune_sha1s[path] = cache.tune_sha1s(path)
+        if sources.get(str(path)) is None or tune_sha1s[path] is None:
+            sources[str(path)], tune_sha1s[path] = hash_tune_file(path,
+                                                                  file_spans)
+
+    for tune in tunes:
+        manifest['tunes'].append({
+            'source': str(tune.path),
+            'label': tune.label,
+            'sha1': tune_sha1s[tune.path][tune.span],
+            'include': lilypond_include_path(tune.label, lilypond_dir),
+        })
+    return manifest
+
+
+def hash_tune_file(path: Path, spans: List[Optional[Tuple[int, int]]]) \
+        -> Tuple[str, Dict[Optional[Tuple[int, int]], str]]:
+    """
+    Hash a tune file and some of its tunes, reading the file once
+
+    Args:
+        path: path of the tune file
+
+        spans: Tune.span of the tunes to hash.  A tune without span is
+            the whole file.
+
+    Returns:
+        A tuple (SHA-1 of the file, {span => SHA-1 of the tune})
+    """
+    import hashlib
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    return sha1, {span: hashlib.sha1(data[span[0]:span[1]]).hexdigest()
+                  if span is not None else sha1 for span in spans}
+
+
+def watch_book(book_path: Path, tune_files_path: Path,
+               cache: TuneMetadataCache, **kwargs):
+    """
+    Generate the tunebook, then generate it again each time the template,
+    the list of tune files, the list of sets or one of the tune files
+    changes.  Never returns.
+
+    Only the changed tune files are parsed again: the other tunes are kept
+    in memory by the cache.  Errors are reported, then the next change is
+    waited for.
+
+    Args: see gen_book()
+    """
+    from watcher import FileWatcher
+    watcher = FileWatcher()
+    while True:
+        paths = [tune_files_path,
+                 kwargs.get('template_path', Path(TEMPLATE_FILENAME)),
+                 kwargs.get('tune_sets_path', Path(TUNE_SETS_FILENAME))]
+        try:
+            paths += read_tune_file_list(tune_files_path)
+        except OSError:
+            pass  # Reported by gen_book() below
+        snapshot = watcher.snapshot(paths)
+
+        start = time.perf_counter()
+        TIMINGS.reset()
+        try:
+            gen_book(book_path, tune_files_path, cache, **kwargs)
+        except (TunebookError, OSError) as e:
+            logging.error('%s', e)
+            logging.error('Failed to generate the tunebook')
+        else:
+            if not CLI_OPTIONS.no_cache:
+                cache.save()
+            logging.info('Tunebook generated in %.0f ms',
+                         (time.perf_counter() - start) * 1000)
+            report_timings()
+
+        logging.info('Waiting for changes...')
+        for path in sorted(watcher.wait_for_changes(snapshot)):
+            logging.info('Changed: %s', path)
+
+
+def load_tune_files(paths: List[Path], cache: TuneMetadataCache = None,
+                    jobs: int = 1,
+                    timings: Timings = None) -> List[List[Tune]]:
+    """
+    Get the tunes of a list of tune files, from the cache if possible.
+
+    The files missing from the cache are parsed by a pool of 'jobs' threads:
+    reading the files is often what takes time, eg on network filesystems.
+
+    Args:
+        paths: paths of ABC or LilyPond tune files
+
+        cache: cache of tune metadata, or None
+
+        jobs: number of tune files to parse in parallel
+
+        timings: if not None, record the cache hits and the parse time of
+            each file
+
+    Returns:
+        For each tune file, in the same order as paths, the list of tunes
+        in the file
+    """
+    for path in paths:
+        if path.suffix not in ('.abc', '.ly'):
+            raise TunebookError('Unsupported tune file type for: {0} '
+                                '(supported types: ABC (.abc), '
+                                'LilyPond (.ly))'.format(path))
+
+    if timings is None:
+        timings = Timings()
+    tunes_by_file = [None] * len(paths)
+    if cache is not None:
+        for i, path in enumerate(paths):
+            start = time.perf_counter()
+            tunes_by_file[i] = cache.get(path)
+            if tunes_by_file[i] is not None:
+                timings.record_file(path, time.perf_counter() - start,
+                                    cached=True)
+                logging.debug('Tune metadata found in cache: %s', path)
+        timings.count('cached_files', sum(tunes is not None
+                                          for tunes in tunes_by_file))
+
+    def parse(path: Path):
+        if cache is None:
+            return None, timed_parse_tune_file(path, timings), None
+        # The file and its tunes are hashed while the file is parsed, not
+        # read a second time
+        tune_sha1s = []
+        fingerprint, tunes = read_with_fingerprint(
+            path, lambda sha1: timed_parse_tune_file(path, timings, sha1,
+                                                     tune_sha1s))
+        return fingerprint, tunes, tune_sha1s
+
+    to_parse = [i for i, tunes in enumerate(tunes_by_file) if tunes is None]
+    if jobs > 1 and len(to_parse) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            parsed = list(executor.map(parse, [paths[i] for i in to_parse]))
+    else:
+        parsed = [parse(paths[i]) for i in to_parse]
+
+    for i, (fingerprint, tunes, tune_sha1s) in zip(to_parse, parsed):
+        tunes_by_file[i] = tunes
+        if cache is not None:
+            cache.put(paths[i], fingerprint, tunes, tune_sha1s)
+
+    return tunes_by_file
 
-            else:
-                logging.error('Unsupported tune file type for: %s', path)
-                logging.error('--- Supported types: ABC (.abc), LilyPond (.ly)')
-                sys.exit(1)
 
-            for tune in new_tunes:
-                assert_tune_uniqueness(new_tune=tune, tunes=tunes)
-                tunes.append(tune)
-                f.writelines(gen_tune(tune.label, tune.title, tune.type))
+def timed_parse_tune_file(path: Path, timings: Timings, digest=None,
+                          tune_digests: Optional[List[str]] = None) \
+        -> List[Tune]:
+    """parse_tune_file(), recording the parse time of the file in
+    timings"""
+    start = time.perf_counter()
+    tunes = parse_tune_file(path, digest, tune_digests)
+    seconds = time.perf_counter() - start
+    timings.add_time('parse', seconds)
+    timings.record_file(path, seconds)
+    return tunes
 
-        # Step 3: copy template lines until %%INSERT_INDEX to tunebook
-        f.writelines(eat_up_template(template, '%%INSERT_INDEX\n'))
 
-        # Step 4: generate index of tunes and write it to tunebook
-        f.write('\\twocolumn\n')
-        f.write(gen_index_of_tunes(tunes))
+def parse_tune_file(path: Path, digest=None,
+                    tune_digests: Optional[List[str]] = None) -> List[Tune]:
+    """
+    Parse an ABC or LilyPond tune file.
+
+    Args:
+        path: path of the tune file
 
-        # Step 5: generate index of sets and write it to tunebook
-        f.writelines(gen_index_of_sets(TUNE_SETS_FILENAME, tunes))
+        digest: if not None, hashlib object to update with the content of
+            the file
 
-        # Step 6: copy remaining template lines to tunebook
-        f.writelines(eat_up_template(template))
+        tune_digests: if not None, the SHA-1 hex digest of each tune is
+            appended to this list (see TuneMetadataCache.tune_sha1s)
+
+    Returns:
+        The list of tunes in the file
+
+    Raises:
+        TunebookError if the file cannot be parsed
+    """
+    if path.suffix == '.abc':
+        # Here we process each ABC file as if it contained
+        # several tunes, even if abcbook.mk can actually deal with
+        # only one multi-tune ABC file.
+        try:
+            return read_abc_file(path, lazy=True, digest=digest,
+                                 tune_digests=tune_digests)
+        except AbcError as e:
+            raise TunebookError('Failed to parse ABC file: {0}: {1}'.format(
+                path, e)) from e
+    else:
+        header = read_lilypond_header(path)
+        tune = Tune(header.title, header.tune_type, path=path)
+        if digest is not None:
+            # The header scan only reads the top of the file
+            update_digest(digest, path)
+        if tune_digests is not None:
+            # The tune is the whole file
+            tune_digests.append(digest.hexdigest() if digest is not None
+                                else file_sha1(path))
+        return [tune]
+
+
+def check_single_tune_abc_file(path: Path, tunes: List[Tune]):
+    """
+    Warn if an ABC file does not contain exactly one tune, or if the file
+    name does not match the tune label.
+
+    Args:
+        path: path of the ABC file
+
+        tunes: tunes found in the file
+    """
+    if len(tunes) == 0:
+        logging.warning('No tune in ABC file: %s', path)
+    elif len(tunes) == 1:
+        if tunes[0].label != path.stem:
+            logging.warning('ABC file name does not match '
+                            'ABC tune title: %s', path)
+            logging.warning('    (should be: %s)',
+                            path.parent / Path(tunes[0].label + '.abc'))
+    else:
+        logging.warning('More than one tune in ABC file: %s', path)
 
 
 def read_tune_file_list(tune_files_path: Path) -> List[Path]:
@@ -178,88 +735,153 @@ def read_tune_file_list(tune_files_path: Path) -> List[Path]:
     return file_paths
 
 
-def eat_up_template(template, tag=None):
-    data = []
-    while template:
-        line = template.pop(0)
-        if (line == tag):
-            break
-        data.append(line)
-    return data
+def read_tune_sets(tune_sets_path: Path) -> Optional[List[str]]:
+    """
+    Read the file containing the list of tune sets
+
+    Returns:
+        The lines of the file, or None (with a warning) if the file cannot
+        be read
+    """
+    try:
+        with open(tune_sets_path, 'r') as f:
+            return f.readlines()
+    except OSError:
+        logging.warning('Cannot open: %s', tune_sets_path)
+        logging.warning('---- I will not generate an index of sets')
+        return None
 
 
-def assert_tune_uniqueness(new_tune: Tune, tunes: List[Tune]):
+def expand_template(template: Iterable[str],
+                    hooks: List[Tuple[str, Callable[[], Iterable[str]]]]) \
+        -> Iterator[str]:
     """
-    Check that a tune is not already present in a list of tunes and stop
-    the program with an explanatory error if so.
+    Copy a template, line by line, and insert the text generated by a hook
+    in place of each tag line of the template.
+
+    A tag line is a line containing only the tag, eg '%%INSERT_TUNES'.  Each
+    hook is called once, on the first occurrence of its tag.  The hooks whose
+    tag is missing from the template are called at the end of the template,
+    in the order of the list.
+
+    Args:
+        template: lines of the template
+
+        hooks: list of (tag, hook) tuples, where hook is a function
+            returning the text to insert, as an iterable of strings
+
+    Returns:
+        An iterator over the text of the output
+    """
+    pending_hooks = dict(hooks)
+    for line in template:
+        hook = pending_hooks.pop(line.rstrip('\n'), None)
+        if hook is None:
+            yield line
+        else:
+            logging.debug('Template tag: %s', line.rstrip('\n'))
+            yield from hook()
+    for hook in pending_hooks.values():
+        yield from hook()
+
+
+def assert_tune_uniqueness(new_tune: Tune, tunes: 'TuneRegistry'):
+    """
+    Check that a tune is not already present in the tunebook and raise
+    an explanatory error if so.
 
     The check is based on the uniqueness of tune labels.  In some cases,
     different tune titles could lead to same labels
 
     Args:
-        new_tune: tune that should not be already in list of tunes
-        tunes: list of tunes
+        new_tune: tune that should not be already in the tunebook
+        tunes: tunes already in the tunebook
 
-    Returns:
-        None
+    Raises:
+        TunebookError if the tune is already in the tunebook
     """
-    for tune in tunes:
-        if tune.label == new_tune.label:
-            logging.error('Found two tunes with same label (~ title):')
-            logging.error('--- "%s" in %s', tune.title, tune.path)
-            logging.error('--- "%s" in %s', new_tune.title, new_tune.path)
-            sys.exit(1)
+    tune = tunes.get(new_tune.label)
+    if tune is not None:
+        raise TunebookError('Found two tunes with same label (~ title):\n'
+                            '--- "{0}" in {1}\n'
+                            '--- "{2}" in {3}'.format(tune.title, tune.path,
+                                                      new_tune.title,
+                                                      new_tune.path))
 
 
 # ------------------------------------------------------------------------
-#     LilyPond file parser
+#     Registry of the tunes in the tunebook
 # ------------------------------------------------------------------------
 
-def get_lilypond_tune_metadata(filepath: Path):
+class TuneRegistry:
     """
-    Find the title and optionally the type of a tune in a LilyPond file.
-    Abort program execution if the file cannot be opened or if there is
-    no title in the file.
+    Tunes of a tunebook, in insertion order, indexed by label (the tune
+    identifier), by title and by type.
 
-    Args:
-        filepath: path of the LilyPond tune file
-
-    Returns:
-        A tuple (title, tune_type)
-        Depending on what is found, title and/or type can be None
+    Title and type lookups are case insensitive.
     """
-    title, tune_type = None, None
+    def __init__(self, tunes: Iterable[Tune] = ()):
+        self._by_label = {}  # label => Tune, in insertion order
+        self._by_title = {}  # lower case title => list of Tune's
+        self._by_type = {}  # lower case type => list of Tune's
+        for tune in tunes:
+            self.add(tune)
 
-    try:
-        with open(filepath, 'r') as f:
-            title_re = re.compile('^\s*title\s*=\s*"(.*)"$')
-            type_re = re.compile('^\s*meter\s*=\s*"(.*)"$')
-
-            for line in f.readlines():
-                if title and tune_type:
-                    break
-
-                if not title:
-                    m = title_re.match(line)
-                    if m:
-                        title = m.group(1).strip()
-                        continue
-
-                if not tune_type:
-                    m = type_re.match(line)
-                    if m:
-                        tune_type = m.group(1).strip().lower()
-                        continue
+    def add(self, tune: Tune):
+        """
+        Add a tune to the registry
+
+        Raises:
+            ValueError if a tune with the same label is already registered
+        """
+        if tune.label in self._by_label:
+            raise ValueError('duplicate tune label: {0}'.format(tune.label))
+        self._by_label[tune.label] = tune
+        self._by_title.setdefault(tune.title.lower(), []).append(tune)
+        self._by_type.setdefault((tune.type or '').lower(), []).append(tune)
+
+    def get(self, label: str) -> Optional[Tune]:
+        """Return the tune with the given label, or None"""
+        return self._by_label.get(label)
+
+    def with_title(self, title: str) -> List[Tune]:
+        """Return the tunes with the given title"""
+        return list(self._by_title.get(title.lower(), []))
+
+    def with_type(self, tune_type: Optional[str]) -> List[Tune]:
+        """Return the tunes of the given type ('' or None: no type)"""
+        return list(self._by_type.get((tune_type or '').lower(), []))
+
+    def __contains__(self, label: str) -> bool:
+        return label in self._by_label
 
+    def __iter__(self) -> Iterator[Tune]:
+        return iter(self._by_label.values())
+
+    def __len__(self) -> int:
+        return len(self._by_label)
+
+
+# ------------------------------------------------------------------------
+#     LilyPond file parser
+# ------------------------------------------------------------------------
+
+def read_lilypond_header(filepath: Path) -> LilypondHeader:
+    """
+    Read the metadata of a LilyPond tune file (see scan_lilypond_header).
+    Raise TunebookError if the file cannot be opened or if there is no
+    title in the file.
+    """
+    try:
+        header = scan_lilypond_header(filepath)
     except FileNotFoundError:
-        logging.error('File not found: %s', filepath)
-        sys.exit(1)
+        raise TunebookError('File not found: {0}'.format(filepath))
 
-    if title is None:
-        logging.error('Missing tune title in LilyPond file: %s', filepath)
-        sys.exit(1)
+    if header.title is None:
+        raise TunebookError('Missing tune title in LilyPond file: {0}'.format(
+            filepath))
 
-    return title, tune_type
+    return header
 
 
 # ------------------------------------------------------------------------
@@ -282,7 +904,7 @@ def gen_tune_label(label):
     return ''.join(tex_label)
 
 
-def gen_lilypond_block(label):
+def gen_lilypond_block(label, lilypond_dir=OUTPUT_DIR):
     block = []
     block.append('\\begin{lilypond}\n')
     #block.append('\\paper {\n')
@@ -294,7 +916,8 @@ def gen_lilypond_block(label):
     #block.append('    }\n')
     #block.append('  }\n')
     #block.append('}\n')
-    block.append('\\include "' + '../../' + CLI_OPTIONS.output_dir + '/' + label + '.ly' + '"' + "\n")
+    block.append('\\include "' + lilypond_include_path(label, lilypond_dir) +
+                 '"' + "\n")
     block.append('\\end{lilypond}\n')
     block.append('\\end{figure}\n')
     #block.append('\\linebreak\n')
@@ -303,7 +926,13 @@ def gen_lilypond_block(label):
     return ''.join(block)
 
 
-def gen_tune(label, title, tune_type):
+def lilypond_include_path(label, lilypond_dir=OUTPUT_DIR):
+    """Path of the LilyPond file of a tune, relative to the directory where
+    lilypond-book is run"""
+    return '../../' + lilypond_dir + '/' + label + '.ly'
+
+
+def gen_tune(label, title, tune_type, lilypond_dir=OUTPUT_DIR):
     data = []
     data.append(gen_tune_header(title, tune_type))
     data.append(gen_tune_label(label))
@@ -317,7 +946,7 @@ def gen_tune(label, title, tune_type):
 #        f.close()
 #    except IOError:
 #        data.append(gen_lilypond_block(label))
-    data.append(gen_lilypond_block(label))
+    data.append(gen_lilypond_block(label, lilypond_dir))
     return data
 
 
@@ -325,12 +954,55 @@ def gen_tune(label, title, tune_type):
 #     Generate the index of tunes
 # ------------------------------------------------------------------------
 
-def gen_index_of_tunes(tunes: List[Tune]):
-    tunes.sort()
-    latex_index = '\\section*{Index des airs}\n'
-    for tune in tunes:
-        latex_index += format_index_entry(tune) + '\n\n'
-    return latex_index
+def gen_index_of_tunes(tunes: Iterable[Tune],
+                       group_by: Optional[str] = None) -> Iterator[str]:
+    """
+    Generate the index of tunes, sorted by title.
+
+    The tunes are neither modified nor reordered: the positions of the
+    tunes are sorted by sort key instead.
+
+    Args:
+        tunes: tunes in the tunebook
+
+        group_by: one of INDEX_GROUPS: None for a single list of tunes,
+            'letter' for a subsection per initial letter of the titles,
+            'type' for a subsection per tune type (tunes without type last)
+
+    Returns:
+        An iterator over the lines of the index in LaTeX format, one entry
+        at a time
+    """
+    tunes = list(tunes)
+    sort_keys = [tune.sort_key for tune in tunes]
+    order = sorted(range(len(tunes)), key=sort_keys.__getitem__)
+
+    yield '\\section*{Index des airs}\n'
+    if group_by is None:
+        for i in order:
+            yield format_index_entry(tunes[i]) + '\n\n'
+    elif group_by == 'letter':
+        initial = None
+        for i in order:
+            key = sort_keys[i]
+            tune_initial = key[:1].upper() if key[:1].isalpha() else '#'
+            if tune_initial != initial:
+                initial = tune_initial
+                yield '\\subsection*{' + initial + '}\n'
+            yield format_index_entry(tunes[i]) + '\n\n'
+    elif group_by == 'type':
+        by_type = {}  # lower case type => positions of the tunes
+        for i in order:
+            by_type.setdefault((tunes[i].type or '').lower(), []).append(i)
+        for tune_type in sorted(by_type, key=lambda t: (t == '', t)):
+            if tune_type == '':
+                yield '\\subsection*{Autres airs}\n'
+            else:
+                yield '\\subsection*{' + tune_type.capitalize() + 's}\n'
+            for i in by_type[tune_type]:
+                yield format_index_entry(tunes[i]) + '\n\n'
+    else:
+        raise ValueError('Unknown index grouping: {0}'.format(group_by))
 
 
 def format_index_entry(tune: Tune) -> str:
@@ -348,26 +1020,43 @@ def format_index_entry(tune: Tune) -> str:
 #     Generate the index of sets
 # ------------------------------------------------------------------------
 
-def gen_index_of_sets(tune_sets_filename: str, tunes: List[Tune]) -> List[str]:
+def gen_index_of_sets(tune_sets_filename: str,
+                      tunes: TuneRegistry) -> List[str]:
     """
     Build the index of tune sets
 
     Args:
         tune_sets_filename: name of the file that contains the list of sets
 
-        tunes: list of tunes in tunebook
+        tunes: tunes in tunebook
 
     Returns:
         A list of lines in LaTeX format to be added to the tunebook.  If no
         tune set can be found, return an empty list.
     """
-    try:
-        f = open(tune_sets_filename)
-    except:
-        logging.warning('Cannot open: %s', tune_sets_filename)
-        logging.warning('---- I will not generate an index of sets')
+    tune_sets = read_tune_sets(Path(tune_sets_filename))
+    if tune_sets is None:
         return []
+    return gen_index_of_sets_from_lines(tune_sets, tunes, tune_sets_filename)
 
+
+def gen_index_of_sets_from_lines(tune_sets: Iterable[str],
+                                 tunes: TuneRegistry,
+                                 sets_name: str = '<tune sets>') -> List[str]:
+    """
+    Build the index of tune sets from the lines of a list of sets
+
+    Args:
+        tune_sets: lines of the list of sets, in the format of the
+            tune_sets.txt file
+
+        tunes: tunes in tunebook
+
+        sets_name: name of the list of sets in warnings
+
+    Returns:
+        See gen_index_of_sets()
+    """
     data = []
     data.append('\\onecolumn\n')
     data.append('\n\n')
@@ -375,7 +1064,7 @@ def gen_index_of_sets(tune_sets_filename: str, tunes: List[Tune]) -> List[str]:
     data.append('\\section*{Index des suites}\n')
 
     nb_of_sets = 0
-    for lineno, line in enumerate(f, start=1):
+    for lineno, line in enumerate(tune_sets, start=1):
         # Each line contains a comma separated list of labels.
         # A line can be empty
         # A line can be a comment starting with #
@@ -388,20 +1077,18 @@ def gen_index_of_sets(tune_sets_filename: str, tunes: List[Tune]) -> List[str]:
         tunes_in_set = []
         for label in set_tunes.split(','):
             label = label.strip()
-            try:
-                tune = [tune for tune in tunes if tune.label == label][0]
+            tune = tunes.get(label)
+            if tune is not None:
                 tunes_in_set.append(tune)
-            except IndexError:
+            else:
                 logging.warning('%s:%d: no tune match label: %s',
-                                tune_sets_filename, lineno, label)
+                                sets_name, lineno, label)
         index_entry = format_set_index_entry(tunes_in_set, set_title)
         data.append(index_entry + '\n\n')
         nb_of_sets += 1
 
-    f.close()
-
     if nb_of_sets == 0:
-        logging.warning('No set in tune sets file: %s', tune_sets_filename)
+        logging.warning('No set in tune sets file: %s', sets_name)
         logging.warning('--- I will not generate an index of sets')
         return []
     else:
@@ -426,12 +1113,12 @@ def format_set_index_entry(tunes_in_set: List[Tune], title=''):
     same_type = True
     set_type = ''
     for tune in tunes_in_set:
-        if tune.type is None:
-            tune.type = ''
+        # The tunes may be shared by several builds: do not modify them
+        tune_type = tune.type or ''
         if set_type == '':
-            set_type = tune.type
+            set_type = tune_type
         else:
-            if set_type != tune.type:
+            if set_type != tune_type:
                 same_type = False
                 break
 
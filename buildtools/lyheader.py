@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Scanner of the metadata of LilyPond tune files
+
+The metadata of a tune (title, type, composer) are in the \\header block at
+the top of the file, and the key and time signature are given at the start
+of the music.  The file is read line by line and the scan stops a few lines
+after the end of the header block, so that large LilyPond files are not read
+in full.
+"""
+
+# Imports from the Python Standard Library:
+from pathlib import Path
+import re
+
+
+# The tune type is stored in the 'meter' header field
+_FIELD_RE = re.compile(r'^\s*(title|meter|composer)\s*=\s*"(.*)"$')
+_HEADER_RE = re.compile(r'\\header\s*\{')
+_KEY_RE = re.compile(r'\\key\s+([a-g])((?:is|es|s)*)\s*\\(major|minor|ionian|'
+                     r'dorian|phrygian|lydian|mixolydian|aeolian|locrian)\b')
+_TIME_RE = re.compile(r'\\time\s+(\d+/\d+)')
+# Start of the music, for the files without a header block
+_MUSIC_RE = re.compile(r'\\(score|book|relative|fixed|new)\b')
+
+# Number of lines read after the end of the header block to find the key and
+# the time signature, which are looked for on a best-effort basis
+MAX_LINES_AFTER_HEADER = 20
+
+_ACCIDENTALS = {'': '', 'is': '#', 'isis': '##', 'es': 'b', 's': 'b',
+                'eses': 'bb', 'ses': 'bb'}
+
+
+class LilypondHeader:
+    """Metadata of a LilyPond tune file.  Missing fields are None."""
+    __slots__ = ('title', 'tune_type', 'composer', 'key', 'time_signature')
+
+    def __init__(self):
+        self.title = None
+        self.tune_type = None  # 'meter' header field, in lower case
+        self.composer = None
+        self.key = None  # eg 'D major', 'F# minor'
+        self.time_signature = None  # eg '6/8'
+
+
+def format_key(note: str, accidentals: str, mode: str) -> str:
+    """Format a LilyPond key, eg ('f', 'is', 'minor') => 'F# minor'"""
+    return note.upper() + _ACCIDENTALS.get(accidentals, '') + ' ' + mode
+
+
+def scan_lilypond_header(path: Path) -> LilypondHeader:
+    """
+    Read the metadata of a LilyPond tune file.
+
+    The first 'title', 'meter' and 'composer' fields of the \\header block
+    are returned.  In a file without a header block, the fields are looked
+    for before the start of the music (eg \\score, \\relative).  The first
+    key and time signature are looked for until MAX_LINES_AFTER_HEADER lines
+    after the end of the header block, where the scan stops.
+
+    Args:
+        path: path of the LilyPond file
+
+    Returns:
+        A LilypondHeader object
+
+    Raises:
+        OSError if the file cannot be read
+    """
+    header = LilypondHeader()
+    depth = None  # Brace depth in the header block, None before the block
+    lines_left = None  # Lines left to read, None until the header is closed
+
+    with open(path, 'r') as f:
+        for line in f:
+            if lines_left is not None:
+                if lines_left == 0:
+                    break
+                lines_left -= 1
+            elif depth is None:
+                m = _HEADER_RE.search(line)
+                if m is not None:
+                    line_in_header = line[m.start():]
+                    depth = (line_in_header.count('{') -
+                             line_in_header.count('}'))
+                    if depth <= 0:
+                        lines_left = MAX_LINES_AFTER_HEADER
+                elif _MUSIC_RE.search(line) is not None:
+                    lines_left = MAX_LINES_AFTER_HEADER
+            else:
+                depth += line.count('{') - line.count('}')
+                if depth <= 0:
+                    lines_left = MAX_LINES_AFTER_HEADER
+
+            if lines_left is None:
+                m = _FIELD_RE.match(line)
+                if m is not None:
+                    name, value = m.group(1), m.group(2).strip()
+                    if name == 'title':
+                        if header.title is None:
+                            header.title = value
+                    elif name == 'meter':
+                        if header.tune_type is None:
+                            header.tune_type = value.lower()
+                    elif header.composer is None:
+                        header.composer = value
+                    continue
+
+            if header.key is None:
+                m = _KEY_RE.search(line)
+                if m is not None:
+                    header.key = format_key(*m.groups())
+            if header.time_signature is None:
+                m = _TIME_RE.search(line)
+                if m is not None:
+                    header.time_signature = m.group(1)
+            if (lines_left is not None and header.key is not None and
+                    header.time_signature is not None):
+                break
+    return header
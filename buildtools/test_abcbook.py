@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+import unittest
+
+from abcbook import *
+
+BUILDTOOLS_DIR = Path(__file__).resolve().parent
+
+# Entry points run by make for each tunebook
+CLI_MODULES = ['abcbook', 'abcbuild', 'abcsplit', 'gen_tex_tunebook']
+
+# Modules which are slow to import and only needed by some options: they
+# must not be imported at startup
+LAZY_MODULES = ['concurrent.futures', 'ctypes', 'multiprocessing', 'watcher',
+                'zipfile']
+
+# Standard modules which the entry points need anyway.  Their import time
+# is the unit of the startup budgets, so that the budgets do not depend on
+# the speed of the machine.
+COMMON_MODULES = ['argparse', 'functools', 'io', 'locale', 'logging', 'os',
+                  'pathlib', 're', 'string', 'typing', 'unicodedata']
+
+# Maximum import time of each entry point, beyond COMMON_MODULES, as a
+# fraction of the import time of COMMON_MODULES.  About twice the highest
+# fractions measured on a developer machine (abcsplit: 0.05, while it had
+# a fraction of 0.4 when it imported hashlib, json and tempfile at
+# startup; gen_tex_tunebook: 0.25; abcbuild: 0.6).
+STARTUP_BUDGETS = {'abcbook': 0.1, 'abcsplit': 0.15,
+                   'gen_tex_tunebook': 0.5, 'abcbuild': 1.2}
+
+
+def run_python(*args, env=None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, '-W', 'ignore'] + list(args),
+                          cwd=str(BUILDTOOLS_DIR), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, env=env)
+
+
+def import_times_ms(code: str, env=None) -> Dict[str, float]:
+    """Run Python code with 'python -X importtime'
+
+    Returns:
+        Module name => import time in ms, including the time to import its
+        dependencies, for the modules imported by the code itself
+    """
+    stderr = run_python('-X', 'importtime', '-c', code, env=env).stderr
+    times = {}
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        # The dependencies of a module are indented
+        if (len(fields) == 3 and fields[1].strip().isdigit() and
+                not fields[2].startswith('  ')):
+            times[fields[2].strip()] = int(fields[1]) / 1000
+    return times
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_modules_are_not_imported(self):
+        for module in CLI_MODULES:
+            stdout = run_python('-c', 'import sys, {0}; print(" ".join('
+                                'sys.modules))'.format(module)).stdout
+            imported = stdout.split()
+            for lazy_module in LAZY_MODULES:
+                self.assertNotIn(lazy_module, imported,
+                                 '{0} imports {1}'.format(module,
+                                                          lazy_module))
+
+    def test_startup_budget(self):
+        # Write the bytecode of the modules once, out of the source tree,
+        # so that it is not compiled again at each run
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=tmp_dir)
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            # The fastest of several runs is the least noisy
+            common_ms = min(sum(import_times_ms(
+                'import ' + ', '.join(COMMON_MODULES), env).values())
+                            for _ in range(5))
+            for module, budget in STARTUP_BUDGETS.items():
+                code = 'import {0}; import {1}'.format(
+                    ', '.join(COMMON_MODULES), module)
+                ms = min(import_times_ms(code, env)[module]
+                         for _ in range(5))
+                self.assertLess(ms, budget * common_ms,
+                                '{0} imports in {1:.1f}ms, the common '
+                                'modules in {2:.1f}ms'.format(module, ms,
+                                                              common_ms))
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_commands_have_a_main_function(self):
+        for module, _ in COMMANDS.values():
+            self.assertTrue(callable(getattr(__import__(module), 'main')))
+
+    def test_unknown_command(self):
+        result = subprocess.run([sys.executable, 'abcbook.py', 'foo'],
+                                cwd=str(BUILDTOOLS_DIR),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        self.assertEqual(2, result.returncode)
+        self.assertIn('unknown command: foo', result.stderr)
+
+    def test_split(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            abc_path = Path(tmp_dir) / 'tunebook.abc'
+            abc_path.write_text('X:1\nT:Our Kate\nR:slow air\nK:D\nDEF|\n')
+            main(['split', '-o', tmp_dir, str(abc_path)])
+            self.assertTrue((Path(tmp_dir) / 'our_kate.abc').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from abcbuild import *
+
+
+class TestIsUpToDate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.source = self.dir / 'tune.abc'
+        self.target = self.dir / 'tune.ly'
+        self.source.write_text('X:1\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_missing_target(self):
+        self.assertFalse(is_up_to_date(self.target, [self.source]))
+
+    def test_newer_target(self):
+        self.target.write_text('\\header {}\n')
+        os.utime(str(self.source), (0, 0))
+        self.assertTrue(is_up_to_date(self.target, [self.source]))
+
+    def test_older_target(self):
+        self.target.write_text('\\header {}\n')
+        os.utime(str(self.target), (0, 0))
+        self.assertFalse(is_up_to_date(self.target, [self.source]))
+
+
+class TestRunConversions(unittest.TestCase):
+
+    def test_failed_conversion(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            src = Path(dirname) / 'tune.abc'
+            src.write_text('X:1\n')
+            ly_path = Path(dirname) / 'tune.ly'
+            with self.assertRaises(BuildError):
+                run_conversions([(src, ly_path)], 2, TuneConverter('false'))
+
+    def test_copy_lilypond_files(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            conversions = []
+            for i in range(4):
+                src = Path(dirname) / 'tune{0}.ly'.format(i)
+                src.write_text('\\header {}\n')
+                conversions.append((src, Path(dirname) / 'out{0}.ly'.format(i)))
+            run_conversions(conversions, 2, TuneConverter('abc4ly.py'))
+            for _, ly_path in conversions:
+                self.assertEqual('\\header {}\n', ly_path.read_text())
+
+
+class TestPlanConversions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        Path('tunebook.abc').write_text('X:1\nT:Our Kate\nK:D\nDEF|\n'
+                                        'X:2\nT:The Mountain Road\nK:D\n'
+                                        'ABC|\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_plan_conversions(self):
+        Path('paddy_fahy_s.ly').write_text('title = "Paddy Fahy\'s"\n')
+        conversions = plan_conversions([Path('tunebook.abc'),
+                                        Path('paddy_fahy_s.ly')], 'tunebook')
+        self.assertEqual([(ABCSPLIT_OUTDIR / 'our_kate.abc',
+                           STAGE1_OUTDIR / 'our_kate.ly'),
+                          (ABCSPLIT_OUTDIR / 'the_mountain_road.abc',
+                           STAGE1_OUTDIR / 'the_mountain_road.ly'),
+                          (Path('paddy_fahy_s.ly'),
+                           STAGE1_OUTDIR / 'paddy_fahy_s.ly')],
+                         conversions)
+        self.assertTrue((ABCSPLIT_OUTDIR / 'our_kate.abc').exists())
+
+    def test_invalid_abc_file(self):
+        Path('tunebook.abc').write_text('X:1\nT:\nK:D\n')
+        with self.assertRaisesRegex(BuildError, 'tunebook.abc: line 2'):
+            plan_conversions([Path('tunebook.abc')], 'tunebook')
+
+    def test_label_collision(self):
+        Path('our_kate.ly').write_text('title = "Our Kate"\n')
+        with self.assertRaisesRegex(BuildError, 'our_kate'):
+            plan_conversions([Path('tunebook.abc'), Path('our_kate.ly')],
+                             'tunebook')
+        self.assertFalse(ABCSPLIT_OUTDIR.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
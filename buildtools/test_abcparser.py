@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import gc
+import hashlib
+import io
+import json
+from pathlib import Path
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from abcparser import *
+
+TEST_TUNEBOOK = Path(__file__).parent.parent / 'test-data' / 'test-tunebook.abc'
+
+
+def write_abc_file(dirname: str, text: str) -> Path:
+    path = Path(dirname) / 'tunes.abc'
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+class TestParseAbcFile(unittest.TestCase):
+
+    def test_parse_test_tunebook(self):
+        tunes = parse_abc_file(TEST_TUNEBOOK)
+        self.assertEqual(['Crock of gold', 'Kitty Lie Over',
+                          'The Monaghan Twig', 'The Mountain Road'],
+                         [tune.title for tune in tunes])
+        self.assertEqual([1, 2, 3, 4], [tune.index for tune in tunes])
+        self.assertEqual(['Reel', 'Jig', 'Reel', 'Reel'],
+                         [tune.type for tune in tunes])
+
+    def test_tune_text(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = write_abc_file(dirname, '% heading\n\nX:1\nT:First\n'
+                                           'K:D\nABC|\n\nX:2\nT:Second\nK:G\n'
+                                           'GAB|\n')
+            tunes = parse_abc_file(path)
+        self.assertEqual('X:1\nT:First\nK:D\nABC|\n', tunes[0].text)
+        self.assertEqual('X:2\nT:Second\nK:G\nGAB|\n', tunes[1].text)
+
+    def test_lazy_parse_same_tunes(self):
+        tunes = parse_abc_file(TEST_TUNEBOOK)
+        lazy_tunes = parse_abc_file(TEST_TUNEBOOK, lazy=True)
+        self.assertEqual([(t.index, t.title, t.type, t.label) for t in tunes],
+                         [(t.index, t.title, t.type, t.label)
+                          for t in lazy_tunes])
+        self.assertEqual([t.text for t in tunes], [t.text for t in lazy_tunes])
+
+    def test_lazy_parse_reads_text_on_access(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = write_abc_file(dirname, 'X:1\r\nT:First\r\n\r\nABC|\r\n'
+                                           'X:2\r\nT:Second\r\nGAB|')
+            tunes = parse_abc_file(path, lazy=True)
+            self.assertIsNone(tunes[0]._text)
+            self.assertEqual('X:1\nT:First\nABC|\n', tunes[0].text)
+            self.assertEqual('X:2\nT:Second\nGAB|', tunes[1].text)
+
+    def test_lazy_parse_does_not_decode_tune_bodies(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = Path(dirname) / 'tunes.abc'
+            # The body is not valid text: only the headers may be decoded
+            path.write_bytes(b'X:1\nT:First\nABC|\xff\xfe|\n\n'
+                             b'  X:2\n  T:Second\n R:reel\nGAB|\n')
+            tunes = parse_abc_file(path, lazy=True)
+        self.assertEqual([(1, 'First', None), (2, 'Second', 'reel')],
+                         [(t.index, t.title, t.type) for t in tunes])
+
+    def test_lazy_parse_digest(self):
+        digest = hashlib.sha1()
+        read_abc_file(TEST_TUNEBOOK, lazy=True, digest=digest)
+        self.assertEqual(hashlib.sha1(TEST_TUNEBOOK.read_bytes()).hexdigest(),
+                         digest.hexdigest())
+
+    def test_lazy_parse_tune_digests(self):
+        tune_digests = []
+        tunes = read_abc_file(TEST_TUNEBOOK, lazy=True,
+                              tune_digests=tune_digests)
+        data = TEST_TUNEBOOK.read_bytes()
+        self.assertEqual([hashlib.sha1(data[start:end]).hexdigest()
+                          for start, end in (tune.span for tune in tunes)],
+                         tune_digests)
+        self.assertEqual(len(tunes), len(set(tune_digests)))
+
+    def test_lazy_parse_empty_file(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = write_abc_file(dirname, '')
+            self.assertEqual([], parse_abc_file(path, lazy=True))
+
+
+class TestValidateAbcFile(unittest.TestCase):
+
+    def test_errors_are_collected(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = write_abc_file(dirname, 'X:1\nT:First\nK:D\nABC|\n'
+                                           'X:2\nT:\nK:D\nDEF|\n'
+                                           'X:3\nX:4\nT:Fourth\nK:G\n'
+                                           'X:five\nT:Fifth\nK:G\n'
+                                           'X:6\nT:Sixth\nK:A\nGAB|\n')
+            tunes, errors = validate_abc_file(path)
+            self.assertEqual(['First', 'Fourth', 'Sixth'],
+                             [tune.title for tune in tunes])
+            self.assertEqual('X:6\nT:Sixth\nK:A\nGAB|\n', tunes[2].text)
+            self.assertEqual([AbcParserError, AbcParserStateMachineError,
+                              AbcParserError],
+                             [type(error) for error in errors])
+            self.assertEqual([6, 10, 13], [error.lineno for error in errors])
+
+            with self.assertRaises(AbcError) as cm:
+                read_abc_file(path)
+            self.assertEqual(6, cm.exception.lineno)
+
+
+class TestParserTrace(unittest.TestCase):
+
+    def test_trace(self):
+        trace = io.StringIO()
+        parser = AbcParserStateMachine(trace=trace, source='tunes.abc')
+        for line in ['% heading\n', 'X:1\n', 'T:First\n', 'K:D\n',
+                     'ABC|\n', 'X:2\n', 'K:G\n']:
+            try:
+                parser.run(line)
+            except AbcError:
+                break
+        records = [json.loads(line) for line in trace.getvalue().splitlines()]
+        self.assertEqual([(1, 'skip'), (2, 'index'), (2, 'transition'),
+                          (3, 'title'), (3, 'transition'), (4, 'line'),
+                          (5, 'line'), (6, 'index'), (6, 'transition'),
+                          (7, 'error')],
+                         [(r['line'], r['event']) for r in records])
+        self.assertEqual({'line': 3, 'state': 'WAIT_TITLE', 'event': 'title',
+                          'value': 'First', 'file': 'tunes.abc'}, records[3])
+        self.assertEqual('READ_TUNE', records[4]['value'])
+
+    def test_no_trace_without_debug(self):
+        parser = AbcParserStateMachine()
+        self.assertFalse(parser._tracing)
+        parser.run('X:1\n')
+        parser.run('T:First\n')
+        self.assertEqual(1, len(parser.get_tunes()))
+
+
+# Number of tunes of the corpus of TestTuneMemory.  The memory ratios do not
+# depend on it: run 'bench_abcbook.py -s 50000' for a 50k-tune corpus.
+CORPUS_SIZE = 2000
+
+
+class TestTuneMemory(unittest.TestCase):
+
+    def test_tune_has_no_dict(self):
+        self.assertFalse(hasattr(Tune('The Mountain Road'), '__dict__'))
+
+    def traced_memory(self, func) -> int:
+        """Return the memory allocated by func and still in use when it
+        returns, eg by the tunes it returns"""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func()
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del result
+        return size
+
+    def test_corpus_memory(self):
+        # The same class with a per-instance __dict__, like the Tune class
+        # before __slots__
+        excluded = set(Tune.__slots__) | {'__slots__', '__dict__',
+                                          '__weakref__'}
+        DictTune = type('DictTune', (), {name: value for name, value
+                                         in vars(Tune).items()
+                                         if name not in excluded})
+        self.assertTrue(hasattr(DictTune(), '__dict__'))
+
+        with tempfile.TemporaryDirectory() as dirname:
+            # Bodies of a usual length (about 1kB)
+            body = '|: "G" B2dB BAGE | "Am" GGGA GED2 | "D" DEGA "G" BGGG |\n'
+            path = write_abc_file(dirname, ''.join(
+                'X:{0}\nT:Tune Number {0}\nR:reel\nM:4/4\nK:G\n{1}\n'
+                .format(i, body * 16) for i in range(CORPUS_SIZE)))
+            with mock.patch('abcparser.Tune', DictTune):
+                dict_size = self.traced_memory(lambda: parse_abc_file(path))
+            eager_size = self.traced_memory(lambda: parse_abc_file(path))
+            lazy_size = self.traced_memory(
+                lambda: parse_abc_file(path, lazy=True))
+
+        # Eager parsing keeps the text of the tunes: only the lazy parsing
+        # reduces the memory 3 times
+        self.assertLess(eager_size, dict_size)
+        self.assertLess(3 * lazy_size, dict_size)
+
+def reference_title_to_label(tune_title: str) -> str:
+    # Character by character implementation of title_to_label() that only
+    # knows a few accented letters, kept to check that labels do not change.
+    label = ''
+    for c in tune_title.lower():
+        if not (c in string.ascii_lowercase or c in string.digits):
+            c = {'í': 'i', 'ú': 'u', 'ó': 'o', 'ç': 'c',
+                 'é': 'e', 'è': 'e', 'ê': 'e'}.get(c, '_')
+        label += c
+    return label
+
+
+class TestTitleToLabel(unittest.TestCase):
+
+    def test_title_to_label(self):
+        self.assertEqual('brid_harper_s', title_to_label("Brid Harper's"))
+        self.assertEqual('les_ridees_de_lanvaudan',
+                         title_to_label('Les Ridées de Lanvaudan'))
+
+    def test_accent_folding(self):
+        self.assertEqual('o_raghallaigh_s', title_to_label("Ó Raghallaigh's"))
+        self.assertEqual('an_dro_a_gwened', title_to_label('An Dro à Gwened'))
+        self.assertEqual('nandu_', title_to_label('Ñandú!'))
+
+    def test_labels_unchanged(self):
+        chars = string.ascii_letters + string.digits + " '-,.!?" + 'íúóçéèê'
+        random.seed(0)
+        for _ in range(1000):
+            title = ''.join(random.choice(chars) for _ in range(30))
+            self.assertEqual(reference_title_to_label(title),
+                             title_to_label(title))
+
+    def test_benchmark_100k_titles(self):
+        random.seed(0)
+        words = ['The', 'Humours', 'of', 'Ballylaughlin', "Paddy", "Fahy's",
+                 'Ó', 'Raghallaigh', 'Ridées', 'Lanvaudan', 'Reel', 'Jig']
+        titles = [' '.join(random.sample(words, 4)) + ' ' + str(i)
+                  for i in range(100000)]
+
+        start = time.perf_counter()
+        for title in titles:
+            reference_title_to_label(title)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for title in titles:
+            title_to_label.__wrapped__(title)  # Bypass the memo cache
+        table_time = time.perf_counter() - start
+
+        self.assertLess(table_time, reference_time)
+
+
+class TestParserBenchmark(unittest.TestCase):
+
+    def time_parse(self, nb_of_lines: int) -> float:
+        parser = AbcParserStateMachine()
+        lines = ['X:1\n', 'T:Long Tune\n', 'R:Reel\n']
+        lines += ['|: "G" B2dB BAGE | "Am" GGGA GED2 :|\n'] * nb_of_lines
+        start = time.perf_counter()
+        for line in lines:
+            parser.run(line)
+        tunes = parser.get_tunes()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(nb_of_lines + 3, tunes[0].text.count('\n'))
+        return elapsed
+
+    def test_parse_time_is_linear(self):
+        # Parsing ten times more lines should take about ten times longer.
+        # The bound is loose to keep the test stable on loaded machines, but
+        # quadratic growth of the tune text would still blow it.
+        self.time_parse(1000)  # warm up
+        small = min(self.time_parse(10000) for _ in range(3))
+        large = min(self.time_parse(100000) for _ in range(3))
+        self.assertLess(large, 30 * small)
+
+
+if __name__ == '__main__':
+    unittest.main()
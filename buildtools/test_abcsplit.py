@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+from pathlib import Path
+import tempfile
+import unittest
+import zipfile
+
+from abcsplit import *
+
+TUNE_1 = 'X:1\nT:The Mountain Road\nR:reel\nK:D\nABC|\n'
+TUNE_2 = 'X:2\nT:Our Kate\nR:slow air\nK:D\nDEF|\n'
+TUNE_3 = 'X:3\nT:Kitty Lie Over\nR:jig\nK:D\nAFD|\n'
+
+
+class TestSplitAbcFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.abc_path = self.dir / 'tunebook.abc'
+        self.output_dir = self.dir / 'splitabc'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def split(self, *tunes):
+        self.abc_path.write_text(''.join(tunes))
+        split_abc_file(self.abc_path, self.output_dir)
+
+    def split_files(self):
+        return sorted(path.name for path in self.output_dir.glob('*.abc'))
+
+    def set_old_mtime(self, filename):
+        os.utime(str(self.output_dir / filename), (0, 0))
+
+    def test_split(self):
+        self.split(TUNE_1, TUNE_2)
+        self.assertEqual(['our_kate.abc', 'the_mountain_road.abc'],
+                         self.split_files())
+        self.assertEqual(TUNE_2, (self.output_dir / 'our_kate.abc').read_text())
+
+    def test_unchanged_files_are_not_written(self):
+        self.split(TUNE_1, TUNE_2)
+        self.set_old_mtime('the_mountain_road.abc')
+        self.set_old_mtime('our_kate.abc')
+
+        self.split(TUNE_1, TUNE_2.replace('DEF|', 'DEFG|'))
+
+        self.assertEqual(0, os.stat(str(self.output_dir /
+                                        'the_mountain_road.abc')).st_mtime)
+        self.assertNotEqual(0, os.stat(str(self.output_dir /
+                                           'our_kate.abc')).st_mtime)
+
+    def test_deleted_file_is_written_again(self):
+        self.split(TUNE_1)
+        os.remove(str(self.output_dir / 'the_mountain_road.abc'))
+        self.split(TUNE_1)
+        self.assertEqual(['the_mountain_road.abc'], self.split_files())
+
+    def test_stale_files_are_removed(self):
+        self.split(TUNE_1, TUNE_2)
+        self.split(TUNE_1, TUNE_3)
+        self.assertEqual(['kitty_lie_over.abc', 'the_mountain_road.abc'],
+                         self.split_files())
+
+    def test_files_from_other_sources_are_kept(self):
+        self.split(TUNE_1)
+        other_abc_path = self.dir / 'other.abc'
+        other_abc_path.write_text(TUNE_2)
+        split_abc_file(other_abc_path, self.output_dir)
+
+        self.split(TUNE_3)
+
+        self.assertEqual(['kitty_lie_over.abc', 'our_kate.abc'],
+                         self.split_files())
+
+    def test_no_temporary_files_left(self):
+        self.split(TUNE_1, TUNE_2)
+        self.split(TUNE_1, TUNE_3)
+        self.assertEqual(['.abcsplit-manifest.json', 'kitty_lie_over.abc',
+                          'the_mountain_road.abc'],
+                         sorted(os.listdir(str(self.output_dir))))
+
+    def test_archive(self):
+        self.abc_path.write_text(TUNE_1 + TUNE_2)
+        archive_path = self.dir / 'tunes.zip'
+        main(['--archive', str(archive_path), str(self.abc_path)])
+        with zipfile.ZipFile(str(archive_path)) as archive:
+            self.assertEqual(['the_mountain_road.abc', 'our_kate.abc'],
+                             archive.namelist())
+            self.assertEqual(TUNE_2, archive.read('our_kate.abc').decode())
+        self.assertEqual(['tunebook.abc', 'tunes.zip'],
+                         sorted(os.listdir(str(self.dir))))
+
+
+class TestSplitAbcFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.output_dir = self.dir / 'splitabc'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_abc_files(self, *texts):
+        paths = []
+        for i, text in enumerate(texts):
+            path = self.dir / 'book{0}.abc'.format(i)
+            path.write_text(text)
+            paths.append(path)
+        return paths
+
+    def test_split_several_files(self):
+        paths = self.write_abc_files(TUNE_1 + TUNE_2, TUNE_3)
+        summary = split_abc_files(paths, self.output_dir, jobs=2)
+        self.assertEqual({'tunes': 3, 'written': 3, 'unchanged': 0,
+                          'removed': 0}, summary)
+        self.assertEqual(['kitty_lie_over.abc', 'our_kate.abc',
+                          'the_mountain_road.abc'],
+                         sorted(path.name for path
+                                in self.output_dir.glob('*.abc')))
+
+        paths[1].write_text(TUNE_1.replace('X:1', 'X:3'))
+        with self.assertRaises(LabelCollisionError):
+            split_abc_files(paths, self.output_dir)
+
+    def test_second_run(self):
+        paths = self.write_abc_files(TUNE_1, TUNE_2 + TUNE_3)
+        split_abc_files(paths, self.output_dir)
+        paths[1].write_text(TUNE_2)
+        summary = split_abc_files(paths, self.output_dir)
+        self.assertEqual({'tunes': 2, 'written': 0, 'unchanged': 2,
+                          'removed': 1}, summary)
+
+    def test_collision_in_one_file(self):
+        paths = self.write_abc_files(TUNE_1 + TUNE_1)
+        with self.assertRaises(LabelCollisionError):
+            split_abc_files(paths, self.output_dir)
+        self.assertFalse(self.output_dir.exists())
+
+    def test_validate(self):
+        paths = self.write_abc_files(TUNE_1 + 'X:4\nT:\nK:D\n' + TUNE_2,
+                                     TUNE_2.replace('X:2', 'X:zz'),
+                                     TUNE_3 + TUNE_2)
+        tunes_by_file, problems = validate_abc_files(paths, jobs=2)
+        self.assertEqual([2, 0, 2],
+                         [len(tunes_by_file[path]) for path in paths])
+        self.assertEqual(3, len(problems))
+        self.assertEqual('{0}: line 7: empty title header field'
+                         .format(paths[0]), problems[0])
+        self.assertIn('our_kate.abc', problems[2])
+        self.assertFalse(self.output_dir.exists())
+
+    def test_error_message_has_the_path(self):
+        paths = self.write_abc_files(TUNE_1, 'X:4\nT:\nK:D\n')
+        for jobs in (1, 2):
+            with self.assertRaises(AbcError) as cm:
+                split_abc_files(paths, self.output_dir, jobs)
+            self.assertEqual('{0}: line 2: empty title header field'
+                             .format(paths[1]), str(cm.exception))
+            self.assertEqual(2, cm.exception.lineno)
+
+    def test_expand_glob_patterns(self):
+        paths = self.write_abc_files(TUNE_1, TUNE_2)
+        pattern = str(self.dir / '*.abc')
+        self.assertEqual(paths,
+                         expand_abc_file_args([pattern, str(paths[0])]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from artifactcache import ArtifactCache, evict_snippets, touch_snippets
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.cache = ArtifactCache(self.dir / 'cache', max_size=250)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def put(self, name, size):
+        src = self.dir / name
+        src.write_text('x' * size)
+        key = ArtifactCache.key(name)
+        self.cache.put(key, src)
+        return key
+
+    def test_key(self):
+        self.assertEqual(ArtifactCache.key('abc4ly', b'X:1\n'),
+                         ArtifactCache.key('abc4ly', 'X:1\n'))
+        self.assertNotEqual(ArtifactCache.key('ab', 'c'),
+                            ArtifactCache.key('a', 'bc'))
+
+    def test_get_put(self):
+        dest = self.dir / 'dest.ly'
+        self.assertFalse(self.cache.get(ArtifactCache.key('tune.ly'), dest))
+        key = self.put('tune.ly', 10)
+        self.assertTrue(self.cache.get(key, dest))
+        self.assertEqual('x' * 10, dest.read_text())
+
+    def test_evict_least_recently_used(self):
+        keys = [self.put('tune{0}.ly'.format(i), 100) for i in range(3)]
+        for i, key in enumerate(keys):
+            path = self.cache.cache_dir / key[:2] / key
+            os.utime(str(path), (i, i))
+        self.cache.get(keys[0], self.dir / 'dest.ly')  # Most recently used
+
+        self.cache.evict()
+
+        self.assertTrue(self.cache.get(keys[0], self.dir / 'dest.ly'))
+        self.assertFalse(self.cache.get(keys[1], self.dir / 'dest.ly'))
+        self.assertTrue(self.cache.get(keys[2], self.dir / 'dest.ly'))
+
+
+class TestSnippets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.snippet_dir = self.dir / 'lilypond-book'
+        # Two snippets of 3 files of 100 bytes, as written by lilypond-book
+        self.snippet_files = {}
+        for i, name in enumerate(['ab/lily-0123', 'cd/lily-4567']):
+            paths = [self.snippet_dir / (name + suffix)
+                     for suffix in ('.ly', '-systems.tex', '-1.eps')]
+            for path in paths:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text('x' * 100)
+                os.utime(str(path), (i, i))
+            self.snippet_files[name] = paths
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_evict_whole_snippets(self):
+        self.assertEqual(300, evict_snippets(self.snippet_dir, 500))
+        self.assertFalse(any(path.exists()
+                             for path in self.snippet_files['ab/lily-0123']))
+        self.assertTrue(all(path.exists()
+                            for path in self.snippet_files['cd/lily-4567']))
+
+    def test_used_snippets_are_kept(self):
+        tex_path = self.dir / 'tunebook.tex'
+        tex_path.write_text('\\input{lilypond-book/ab/lily-0123-systems.tex}')
+        touch_snippets(self.snippet_dir, tex_path)
+        evict_snippets(self.snippet_dir, 500)
+        self.assertTrue(all(path.exists()
+                            for path in self.snippet_files['ab/lily-0123']))
+        self.assertFalse(any(path.exists()
+                             for path in self.snippet_files['cd/lily-4567']))
+
+
+if __name__ == '__main__':
+    unittest.main()
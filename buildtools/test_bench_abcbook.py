@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+from bench_abcbook import *
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_gen_corpus(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            abc_path = gen_corpus(Path(tmp_dir), 50)
+            tunes = parse_abc_file(abc_path)
+            self.assertEqual(50, len(tunes))
+            self.assertEqual(50, len({tune.label for tune in tunes}))
+            sets = (Path(tmp_dir) / 'bookspecs/tune_sets.txt').read_text()
+            self.assertEqual(50 // 3 + 1, len(sets.splitlines()))
+
+    def test_run_benchmarks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = run_benchmarks(Path(tmp_dir), 30, repeat=1)
+        self.assertIn('gen_book', results)
+        self.assertIn('split_abc_file', results)
+        for result in results.values():
+            self.assertGreater(result['seconds'], 0)
+            self.assertGreater(result['tunes_per_second'], 0)
+
+    def test_compare_results(self):
+        baseline = {'sizes': {'1000': {
+            'gen_book': {'seconds': 1.0, 'peak_memory_kb': 100},
+            'parse_abc_file': {'seconds': 1.0, 'peak_memory_kb': 100}}}}
+        results = {'sizes': {'1000': {
+            'gen_book': {'seconds': 1.05, 'peak_memory_kb': 100},
+            'parse_abc_file': {'seconds': 2.0, 'peak_memory_kb': 100}}}}
+        lines, regression = compare_results(baseline, results, 0.25)
+        self.assertTrue(regression)
+        self.assertNotIn('SLOWER', lines[1])  # gen_book
+        self.assertIn('SLOWER', lines[2])  # parse_abc_file
+
+        results['sizes']['1000']['parse_abc_file']['seconds'] = 0.5
+        lines, regression = compare_results(baseline, results, 0.25)
+        self.assertFalse(regression)
+        self.assertIn('faster', lines[2])
+
+    def test_default_baseline(self):
+        with open(DEFAULT_BASELINE) as f:
+            baseline = json.load(f)
+        self.assertEqual(RESULTS_FORMAT_VERSION, baseline['version'])
+        self.assertEqual(sorted(str(size) for size in DEFAULT_SIZES),
+                         sorted(baseline['sizes']))
+        for benchmarks in baseline['sizes'].values():
+            self.assertIn('gen_book', benchmarks)
+
+    def test_compare_with_default_baseline(self):
+        self.assertEqual(str(DEFAULT_BASELINE),
+                         parse_command_line([]).compare)
+        self.assertIsNone(parse_command_line(['--no-compare']).compare)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import hashlib
+import tempfile
 import unittest
+from unittest import mock
 
 from abcparser import demote_determinant
 from gen_tex_tunebook import *
@@ -37,6 +40,17 @@ class TestTuneIndex(unittest.TestCase):
                           Tune("Mistress on the Floor", "reel"),
                           Tune("Yellow Tinker", "reel")], tunes)
 
+    def test_sort_by_name_ignore_accents(self):
+        tunes = [Tune("Paddy Fahy's", "reel"),
+                 Tune("Ó Raghallaigh's", "reel"),
+                 Tune("Old Bush", "reel"),
+                 Tune("An Ghaoth Aneas", "reel")]
+
+        tunes.sort()
+
+        self.assertEqual(["An Ghaoth Aneas", "Ó Raghallaigh's", "Old Bush",
+                          "Paddy Fahy's"], [tune.title for tune in tunes])
+
     def test_demote_determinant(self):
         self.assertEqual("Yellow Tinker, The", demote_determinant("The Yellow Tinker"))
 
@@ -80,7 +94,7 @@ class TestTuneIndex(unittest.TestCase):
                  Tune("Toss the Feathers", "reel"),
                  Tune("Mistress on the Floor", "reel")]
 
-        latex_index = gen_index_of_tunes(tunes)
+        latex_index = ''.join(gen_index_of_tunes(tunes))
 
         expected_latex_index = r"""\section*{Index des airs}
 \emph{Come Upstairs with Me}~(slip jig),~p.\pageref{come_upstairs_with_me}
@@ -95,6 +109,50 @@ class TestTuneIndex(unittest.TestCase):
 
         self.assertEqual(expected_latex_index, latex_index)
 
+    def test_gen_index_of_tunes_keeps_order(self):
+        tunes = [Tune("Toss the Feathers", "reel"),
+                 Tune("Come Upstairs with Me", "slip jig")]
+
+        list(gen_index_of_tunes(tunes))
+
+        self.assertEqual(["Toss the Feathers", "Come Upstairs with Me"],
+                         [tune.title for tune in tunes])
+
+    def test_gen_index_of_tunes_by_letter(self):
+        tunes = [Tune("Toss the Feathers", "reel"),
+                 Tune("Ó Raghallaigh's", "reel"),
+                 Tune("The Old Bush", "reel"),
+                 Tune("Tripping up the Stairs", "jig")]
+
+        index = list(gen_index_of_tunes(tunes, group_by='letter'))
+
+        self.assertEqual(['\\section*{Index des airs}\n',
+                          '\\subsection*{O}\n', 'o_raghallaigh_s',
+                          'the_old_bush', '\\subsection*{T}\n',
+                          'toss_the_feathers', 'tripping_up_the_stairs'],
+                         [line if line.startswith('\\') and 'section' in line
+                          else line.split('pageref{')[1].split('}')[0]
+                          for line in index])
+
+    def test_gen_index_of_tunes_by_type(self):
+        tunes = [Tune("Toss the Feathers", "reel"),
+                 Tune("The Mysterious Tune"),
+                 Tune("Come Upstairs with Me", "slip jig"),
+                 Tune("Mistress on the Floor", "Reel")]
+
+        index = ''.join(gen_index_of_tunes(tunes, group_by='type'))
+
+        self.assertLess(index.index('\\subsection*{Reels}'),
+                        index.index('mistress_on_the_floor'))
+        self.assertLess(index.index('mistress_on_the_floor'),
+                        index.index('toss_the_feathers'))
+        self.assertLess(index.index('toss_the_feathers'),
+                        index.index('\\subsection*{Slip jigs}'))
+        self.assertLess(index.index('come_upstairs_with_me'),
+                        index.index('\\subsection*{Autres airs}'))
+        self.assertLess(index.index('\\subsection*{Autres airs}'),
+                        index.index('the_mysterious_tune'))
+
 
 class TestFormatSetIndexEntry(unittest.TestCase):
 
@@ -147,6 +205,8 @@ class TestFormatSetIndexEntry(unittest.TestCase):
         index_entry = format_set_index_entry(tunes)
 
         self.assertEqual(expected_index_entry, index_entry)
+        # The tunes may be shared by other builds
+        self.assertEqual([None, None], [tune.type for tune in tunes])
 
     def test_set_index_entry_only_one_tune(self):
         # One entry without type
@@ -212,6 +272,288 @@ class TestParseSet(unittest.TestCase):
         self.assertEqual("", index_tunes)
 
 
+class TestTuneRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tunes = TuneRegistry([Tune("The Mountain Road", "reel"),
+                                   Tune("Our Kate", "slow air"),
+                                   Tune("The Twelve Pins", "Reel"),
+                                   Tune("The Mysterious Tune")])
+
+    def test_get(self):
+        self.assertEqual("Our Kate", self.tunes.get("our_kate").title)
+        self.assertIsNone(self.tunes.get("unknown_tune"))
+        self.assertIn("the_twelve_pins", self.tunes)
+
+    def test_insertion_order(self):
+        self.assertEqual(["the_mountain_road", "our_kate", "the_twelve_pins",
+                          "the_mysterious_tune"],
+                         [tune.label for tune in self.tunes])
+        self.assertEqual(4, len(self.tunes))
+
+    def test_duplicate_label(self):
+        with self.assertRaises(ValueError):
+            self.tunes.add(Tune("Our-Kate"))
+
+    def test_secondary_indexes(self):
+        self.assertEqual(["the_mountain_road", "the_twelve_pins"],
+                         [tune.label for tune in self.tunes.with_type("reel")])
+        self.assertEqual(["the_mysterious_tune"],
+                         [tune.label for tune in self.tunes.with_type(None)])
+        self.assertEqual(["our_kate"],
+                         [tune.label
+                          for tune in self.tunes.with_title("our kate")])
+
+    def test_gen_index_of_sets(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            sets_path = Path(dirname) / 'tune_sets.txt'
+            sets_path.write_text("# Sets\n\n"
+                                 "the_mountain_road, the_twelve_pins\n")
+            data = gen_index_of_sets(str(sets_path), self.tunes)
+        self.assertEqual(r"""\emph{The Mountain Road}~(reel,~p.\pageref{the_mountain_road})~/ \emph{The Twelve Pins}~(Reel,~p.\pageref{the_twelve_pins})""" + "\n\n",
+                         data[-1])
+
+
+class TestExpandTemplate(unittest.TestCase):
+
+    def process(self, template_text):
+        hooks = [('%%INSERT_TUNES', lambda: ['<tunes>\n']),
+                 ('%%INSERT_INDEX', lambda: ['<index>\n'])]
+        return ''.join(expand_template(
+            template_text.splitlines(keepends=True), hooks))
+
+    def test_expand_template(self):
+        self.assertEqual('begin\n<tunes>\nmiddle\n<index>\nend\n',
+                         self.process('begin\n%%INSERT_TUNES\nmiddle\n'
+                                      '%%INSERT_INDEX\nend\n'))
+
+    def test_expand_template_missing_tag(self):
+        self.assertEqual('begin\n<tunes>\nend\n<index>\n',
+                         self.process('begin\n%%INSERT_TUNES\nend\n'))
+
+
+class TestTunebookBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = TunebookBuilder('begin\n%%INSERT_TUNES\n'
+                                       '%%INSERT_INDEX\nend\n',
+                                       lilypond_dir='lily')
+        self.tunes = [Tune("The Mountain Road", "reel"),
+                      Tune("Our Kate", "slow air")]
+
+    def test_build(self):
+        book = self.builder.build(self.tunes,
+                                  ['the_mountain_road, our_kate\n'])
+        self.assertTrue(book.startswith('begin\n\\begin{figure}[H]\n'
+                                        '\\label{the_mountain_road}\n'))
+        self.assertIn('\\include "../../lily/our_kate.ly"\n', book)
+        self.assertIn('\\section*{Index des airs}\n', book)
+        self.assertIn('\\section*{Index des suites}\n', book)
+        self.assertTrue(book.endswith('end\n'))
+
+    def test_build_without_sets(self):
+        book = self.builder.build(self.tunes)
+        self.assertNotIn('Index des suites', book)
+
+    def test_duplicate_tunes(self):
+        with self.assertRaises(TunebookError):
+            self.builder.stream(self.tunes + [Tune("Our-Kate")])
+
+    def test_concurrent_builds(self):
+        other_tunes = [Tune("The Twelve Pins", "reel")]
+        first = self.builder.stream(self.tunes)
+        second = self.builder.stream(other_tunes)
+        second_book = ''.join(second)
+        self.assertEqual(self.builder.build(self.tunes), ''.join(first))
+        self.assertEqual(self.builder.build(other_tunes), second_book)
+
+    def test_template_lines(self):
+        builder = TunebookBuilder(['begin\n', '%%INSERT_TUNES\n',
+                                   '%%INSERT_INDEX\n', 'end\n'],
+                                  lilypond_dir='lily')
+        self.assertEqual(self.builder.build(self.tunes),
+                         builder.build(self.tunes))
+
+    def test_from_template_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = Path(tmp_dir) / 'tunebook.tex'
+            template_path.write_text('begin\n%%INSERT_TUNES\n'
+                                     '%%INSERT_INDEX\nend\n')
+            builder = TunebookBuilder.from_template_file(
+                template_path, lilypond_dir='lily')
+            book = builder.build(self.tunes)
+            self.assertEqual(self.builder.build(self.tunes), book)
+            # The template is read again for each tunebook
+            self.assertEqual(book, builder.build(self.tunes))
+
+    def test_missing_template_file(self):
+        with self.assertRaises(OSError):
+            TunebookBuilder.from_template_file(Path('no_such_template.tex'))
+
+
+class TestReplaceIfChanged(unittest.TestCase):
+
+    def test_replace_if_changed(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = Path(dirname) / 'tunebook.lytex'
+            tmp_path = Path(dirname) / 'tunebook.lytex.tmp'
+            path.write_text('old\n')
+            os.utime(str(path), (0, 0))
+
+            tmp_path.write_text('old\n')
+            self.assertFalse(replace_if_changed(tmp_path, path))
+            self.assertEqual(0, os.stat(str(path)).st_mtime)
+            self.assertFalse(tmp_path.exists())
+
+            tmp_path.write_text('new\n')
+            self.assertTrue(replace_if_changed(tmp_path, path))
+            self.assertEqual('new\n', path.read_text())
+            self.assertFalse(tmp_path.exists())
+
+
+class TestDepsManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.abc_path = self.dir / 'tunebook.abc'
+        self.abc_path.write_text('X:1\nT:The Mountain Road\nR:reel\nK:D\n'
+                                 'ABC|\nX:2\nT:Our Kate\nR:slow air\nK:D\n'
+                                 'DEF|\n')
+        self.ly_path = self.dir / 'paddy_fahy_s.ly'
+        self.ly_path.write_text('\\header {\n  title = "Paddy Fahy\'s"\n'
+                                '  meter = "Jig"\n}\n')
+        self.tune_files_path = self.dir / 'tune_files.txt'
+        self.tune_files_path.write_text('{0}\n{1}\n'.format(self.abc_path,
+                                                            self.ly_path))
+        self.template_path = self.dir / 'book_template.tex'
+        self.template_path.write_text('%%INSERT_TUNES\n%%INSERT_INDEX\n')
+        self.book_path = self.dir / 'tunebook.lytex'
+        self.manifest_path = self.dir / 'tunebook.deps.json'
+        self.cache = TuneMetadataCache(self.dir / 'cache.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def gen_book(self):
+        gen_book(self.book_path, self.tune_files_path, cache=self.cache,
+                 manifest_path=self.manifest_path,
+                 template_path=self.template_path,
+                 tune_sets_path=self.dir / 'tune_sets.txt',
+                 lilypond_dir='out')
+
+    def test_manifest(self):
+        self.gen_book()
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual({str(self.abc_path): file_sha1(self.abc_path),
+                          str(self.ly_path): file_sha1(self.ly_path)},
+                         manifest['sources'])
+        self.assertEqual([(str(self.abc_path), 'the_mountain_road'),
+                          (str(self.abc_path), 'our_kate'),
+                          (str(self.ly_path), 'paddy_fahy_s')],
+                         [(tune['source'], tune['label'])
+                          for tune in manifest['tunes']])
+        self.assertEqual(lilypond_include_path('our_kate', 'out'),
+                         manifest['tunes'][1]['include'])
+        self.assertEqual(hashlib.sha1(b'X:2\nT:Our Kate\nR:slow air\nK:D\n'
+                                      b'DEF|\n').hexdigest(),
+                         manifest['tunes'][1]['sha1'])
+        self.assertEqual(file_sha1(self.ly_path), manifest['tunes'][2]['sha1'])
+
+    def test_manifest_without_cache(self):
+        self.gen_book()
+        with open(self.manifest_path) as f:
+            cached_manifest = json.load(f)
+        tunes = parse_tune_file(self.abc_path) + parse_tune_file(self.ly_path)
+        self.assertEqual(cached_manifest,
+                         gen_deps_manifest(tunes, self.tune_files_path,
+                                           self.template_path,
+                                           self.dir / 'tune_sets.txt',
+                                           'out'))
+
+    def test_only_the_edited_tune_hash_changes(self):
+        self.gen_book()
+        with open(self.manifest_path) as f:
+            before = json.load(f)
+        self.abc_path.write_text('X:1\nT:The Mountain Road\nR:reel\nK:D\n'
+                                 'ABC|\nX:2\nT:Our Kate\nR:slow air\nK:D\n'
+                                 'DEFG|\n')
+        self.gen_book()
+        with open(self.manifest_path) as f:
+            after = json.load(f)
+        self.assertEqual([True, False, True],
+                         [old['sha1'] == new['sha1'] for old, new
+                          in zip(before['tunes'], after['tunes'])])
+
+    def test_sha1_taken_from_cache(self):
+        self.gen_book()
+        with mock.patch('gen_tex_tunebook.hash_tune_file',
+                        side_effect=AssertionError('file hashed again')):
+            manifest = gen_deps_manifest(
+                self.cache.get(self.abc_path) + self.cache.get(self.ly_path),
+                self.tune_files_path, cache=self.cache)
+        self.assertEqual(file_sha1(self.abc_path),
+                         manifest['sources'][str(self.abc_path)])
+
+    def test_failed_write_leaves_no_tmp_file(self):
+        with mock.patch('gen_tex_tunebook.json.dump',
+                        side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                self.gen_book()
+        self.assertTrue(self.book_path.exists())
+        self.assertFalse(self.manifest_path.exists())
+        self.assertEqual([], list(self.dir.glob('*.tmp')))
+
+    def test_unchanged_outputs_are_not_rewritten(self):
+        self.gen_book()
+        for path in (self.book_path, self.manifest_path):
+            os.utime(str(path), (0, 0))
+        self.gen_book()
+        for path in (self.book_path, self.manifest_path):
+            self.assertEqual(0, os.stat(str(path)).st_mtime)
+        self.assertEqual([], list(self.dir.glob('*.tmp')))
+
+        self.ly_path.write_text('\\header {\n  title = "Paddy Fahy\'s"\n'
+                                '  meter = "Reel"\n}\n')
+        self.gen_book()
+        self.assertNotEqual(0, os.stat(str(self.manifest_path)).st_mtime)
+
+
+class TestLoadTuneFiles(unittest.TestCase):
+
+    def test_load_tune_files_in_parallel_keeps_order(self):
+        titles = ['Tune {0}'.format(i) for i in range(20)]
+        with tempfile.TemporaryDirectory() as dirname:
+            paths = []
+            for i, title in enumerate(titles):
+                if i % 2:
+                    path = Path(dirname) / 'tune_{0}.ly'.format(i)
+                    text = 'title = "{0}"\n'.format(title)
+                else:
+                    path = Path(dirname) / 'tune_{0}.abc'.format(i)
+                    text = 'X:1\nT:{0}\nK:D\nABC|\n'.format(title)
+                path.write_text(text)
+                paths.append(path)
+
+            tunes_by_file = load_tune_files(paths, jobs=4)
+
+        self.assertEqual([[title] for title in titles],
+                         [[tune.title for tune in tunes]
+                          for tunes in tunes_by_file])
+
+    def test_abc_files_are_read_once(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = Path(dirname) / 'tunes.abc'
+            path.write_text('X:1\nT:Our Kate\nK:D\nDEF|\n')
+            cache = TuneMetadataCache(Path(dirname) / 'cache.json')
+            # The SHA-1 is computed by the parser, from the mapped file
+            with mock.patch('tunecache.update_digest',
+                            side_effect=AssertionError('file read again')):
+                load_tune_files([path], cache)
+            self.assertEqual(file_sha1(path), cache.sha1(path))
+
+
 if __name__ == '__main__':
     unittest.main()
 
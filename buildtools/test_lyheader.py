@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from pathlib import Path
+import tempfile
+import unittest
+
+from lyheader import *
+
+TUNE = r'''\version "2.18.2"
+\header {
+  title = "Paddy Fahy's"
+  meter = "Reel"
+  composer = "Paddy Fahy"
+  tagline = ""
+}
+melody = \relative c'' {
+  \clef treble
+  \key fis \minor
+  \time 4/4
+  a4 b c d
+}
+'''
+
+
+class TestScanLilypondHeader(unittest.TestCase):
+
+    def scan(self, text):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = Path(dirname) / 'tune.ly'
+            path.write_text(text)
+            return scan_lilypond_header(path)
+
+    def test_scan(self):
+        header = self.scan(TUNE)
+        self.assertEqual("Paddy Fahy's", header.title)
+        self.assertEqual('reel', header.tune_type)
+        self.assertEqual('Paddy Fahy', header.composer)
+        self.assertEqual('F# minor', header.key)
+        self.assertEqual('4/4', header.time_signature)
+
+    def test_missing_fields(self):
+        header = self.scan('\\header {\n  title = "Our Kate"\n}\n')
+        self.assertEqual('Our Kate', header.title)
+        self.assertIsNone(header.tune_type)
+        self.assertIsNone(header.key)
+
+    def test_stop_after_header(self):
+        text = TUNE.replace('\\key fis \\minor\n', '')
+        text += '  a4 b c d\n' * (MAX_LINES_AFTER_HEADER + 10)
+        text += '  \\key d \\major\n'
+        self.assertIsNone(self.scan(text).key)
+
+    def test_stop_after_header_without_title(self):
+        # The rest of the file is not searched for a title
+        header = self.scan('\\header {\n  tagline = ""\n}\n' +
+                           'a4\n' * (MAX_LINES_AFTER_HEADER + 10) +
+                           '  title = "Late Title"\n')
+        self.assertIsNone(header.title)
+
+    def test_no_header_block(self):
+        header = self.scan('title = "Our Kate"\nmeter = "Slow Air"\n'
+                           'melody = \\relative c\' {\n  \\key d \\major\n'
+                           '  \\time 3/4\n  title = "Not A Title"\n}\n')
+        self.assertEqual('Our Kate', header.title)
+        self.assertEqual('slow air', header.tune_type)
+        self.assertEqual('D major', header.key)
+        self.assertEqual('3/4', header.time_signature)
+
+    def test_fields_are_not_read_after_the_music(self):
+        header = self.scan('\\score {\n  a4\n}\ntitle = "Late Title"\n')
+        self.assertIsNone(header.title)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import io
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+from timings import *
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_stages_are_accumulated(self):
+        timings = Timings()
+        for _ in range(3):
+            with timings.stage('parse'):
+                pass
+        self.assertEqual(3, timings.stages['parse']['calls'])
+        self.assertGreaterEqual(timings.stages['parse']['seconds'], 0)
+
+    def test_stage_is_recorded_on_exception(self):
+        timings = Timings()
+        with self.assertRaises(ValueError):
+            with timings.stage('index_of_sets'):
+                raise ValueError()
+        self.assertEqual(1, timings.stages['index_of_sets']['calls'])
+
+    def test_write_json(self):
+        timings = Timings()
+        timings.add_time('template', 0.5)
+        timings.record_file(Path('tunes/our_kate.abc'), 0.25)
+        timings.count('tunes', 2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'timings.json'
+            timings.write_json(path)
+            data = json.loads(path.read_text())
+        self.assertEqual({'calls': 1, 'seconds': 0.5},
+                         data['stages']['template'])
+        self.assertEqual({'cached': False, 'seconds': 0.25},
+                         data['files']['tunes/our_kate.abc'])
+        self.assertEqual({'tunes': 2}, data['counts'])
+        self.assertIn('peak_memory_kb', data)
+
+    def test_print_report(self):
+        timings = Timings()
+        timings.add_time('parse', 0.002)
+        timings.record_file(Path('tunes/our_kate.abc'), 0.002)
+        f = io.StringIO()
+        timings.print_report(file=f)
+        self.assertIn('parse', f.getvalue())
+        self.assertIn('tunes/our_kate.abc', f.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
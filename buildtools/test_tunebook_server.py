@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import asyncio
+import json
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+import gen_tex_tunebook
+from tunebook_server import *
+
+TEMPLATE = 'begin\n%%INSERT_TUNES\n%%INSERT_INDEX\nend\n'
+
+
+class TestTunebookService(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        (self.dir / 'bookspecs').mkdir()
+        (self.dir / 'bookspecs' / 'book_template.tex').write_text(TEMPLATE)
+        (self.dir / 'bookspecs' / 'tune_files.txt').write_text(
+            'tunes/our_kate.abc\n')
+        (self.dir / 'bookspecs' / 'tune_sets.txt').write_text(
+            'our_kate, the_mountain_road\n')
+        (self.dir / 'tunes').mkdir()
+        (self.dir / 'tunes' / 'our_kate.abc').write_text(
+            'X:1\nT:Our Kate\nR:slow air\nK:D\nDEF|\n')
+        (self.dir / 'tunes' / 'the_mountain_road.abc').write_text(
+            'X:1\nT:The Mountain Road\nR:reel\nK:D\nABC|\n')
+        self.service = TunebookService(self.dir, jobs=2)
+
+    def tearDown(self):
+        self.service.close()
+        self.tmp_dir.cleanup()
+
+    async def request(self, method, target, body=b''):
+        server = await asyncio.start_server(self.service.handle_connection,
+                                            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('{0} {1} HTTP/1.1\r\nContent-Length: {2}\r\n\r\n'
+                         .format(method, target, len(body)).encode() + body)
+            response = await reader.read()
+            writer.close()
+        head, _, content = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), content.decode('utf-8')
+
+    async def test_default_tunebook(self):
+        status, content = await self.request('POST', '/tunebook')
+        self.assertEqual(200, status)
+        self.assertTrue(content.startswith('begin\n'))
+        self.assertIn('\\label{our_kate}', content)
+
+    async def test_tune_list(self):
+        body = json.dumps({'tune_files': ['tunes/the_mountain_road.abc',
+                                          'tunes/our_kate.abc'],
+                           'tune_sets': ['the_mountain_road, our_kate']})
+        status, content = await self.request('POST', '/tunebook',
+                                             body.encode())
+        self.assertEqual(200, status)
+        self.assertLess(content.index('\\label{the_mountain_road}'),
+                        content.index('\\label{our_kate}'))
+        self.assertIn('Index des suites', content)
+
+    async def test_errors(self):
+        status, _ = await self.request('POST', '/tunebook', b'{')
+        self.assertEqual(400, status)
+        body = json.dumps({'tune_files': ['../secret.abc']})
+        status, _ = await self.request('POST', '/tunebook', body.encode())
+        self.assertEqual(400, status)
+        body = json.dumps({'tune_files': ['tunes/missing.abc']})
+        status, _ = await self.request('POST', '/tunebook', body.encode())
+        self.assertEqual(422, status)
+        status, _ = await self.request('GET', '/unknown')
+        self.assertEqual(404, status)
+
+    async def test_identical_requests_are_coalesced(self):
+        paths = [self.dir / 'tunes' / 'our_kate.abc']
+        books = await asyncio.gather(self.service.get_tunebook(paths, None),
+                                     self.service.get_tunebook(paths, None))
+        self.assertEqual(books[0], books[1])
+        self.assertEqual(1, self.service.stats['generations'])
+        self.assertEqual(1, self.service.stats['coalesced'])
+
+    async def test_tunes_are_shared(self):
+        paths = [self.dir / 'tunes' / 'our_kate.abc']
+        await self.service.get_tunebook(paths, None)
+        tune = self.service.cache.get(paths[0])[0]
+        await self.service.get_tunebook(paths, ['our_kate'])
+        self.assertIs(tune, self.service.cache.get(paths[0])[0])
+
+    def test_global_timings_are_not_recorded(self):
+        gen_tex_tunebook.TIMINGS.reset()
+        self.service.generate([self.dir / 'tunes' / 'our_kate.abc'], None)
+        self.assertEqual({}, gen_tex_tunebook.TIMINGS.files)
+
+    def test_bookname(self):
+        _, _, bookname = self.service.parse_request({})
+        self.assertEqual(DEFAULT_BOOKNAME, bookname)
+        (self.dir / 'tunebook.abc').write_text('')
+        with self.assertRaises(RequestError):
+            self.service.parse_request({'bookname': 'tunebook'})
+
+    async def test_pdf_builds_are_serialized(self):
+        running = []
+        overlaps = []
+
+        class Process:
+            async def wait(self):
+                running.append(self)
+                overlaps.append(len(running))
+                await asyncio.sleep(0.01)
+                running.remove(self)
+                return 0
+
+        async def create_subprocess_exec(*args, **kwargs):
+            return Process()
+
+        paths = [self.dir / 'tunes' / 'our_kate.abc']
+        with mock.patch('asyncio.create_subprocess_exec',
+                        create_subprocess_exec):
+            self.assertEqual('started', self.service.start_pdf_build(
+                'first', paths, None))
+            self.assertEqual('busy', self.service.start_pdf_build(
+                'first', paths, None))
+            self.assertEqual('started', self.service.start_pdf_build(
+                'second', paths, None))
+            await asyncio.gather(*self.service._pdf_builds.values())
+        self.assertEqual([1, 1], overlaps)
+
+
+if __name__ == '__main__':
+    unittest.main()
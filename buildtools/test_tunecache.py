@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from abcparser import Tune, parse_abc_file
+from tunecache import TuneMetadataCache, file_fingerprint
+
+
+class TestTuneMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.cache_path = self.dir / 'cache.json'
+        self.abc_path = self.dir / 'tunes.abc'
+        self.write_abc('X:1\nT:The Mountain Road\nR:reel\nK:D\nABC|\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_abc(self, text):
+        with open(self.abc_path, 'w') as f:
+            f.write(text)
+
+    def cached_tunes(self):
+        cache = TuneMetadataCache(self.cache_path)
+        cache.load()
+        return cache.get(self.abc_path)
+
+    def fill_cache(self):
+        cache = TuneMetadataCache(self.cache_path)
+        cache.put(self.abc_path, file_fingerprint(self.abc_path),
+                  parse_abc_file(self.abc_path, lazy=True))
+        cache.save()
+
+    def test_hit(self):
+        self.fill_cache()
+        tunes = self.cached_tunes()
+        self.assertEqual(1, len(tunes))
+        self.assertEqual('The Mountain Road', tunes[0].title)
+        self.assertEqual('reel', tunes[0].type)
+        self.assertEqual(1, tunes[0].index)
+        self.assertEqual('the_mountain_road', tunes[0].label)
+        self.assertEqual(self.abc_path, tunes[0].path)
+        self.assertEqual('X:1\nT:The Mountain Road\nR:reel\nK:D\nABC|\n',
+                         tunes[0].text)
+
+    def test_miss_when_content_changed(self):
+        self.fill_cache()
+        self.write_abc('X:1\nT:The Twelve Pins\nR:reel\nK:D\nABC|\n')
+        self.assertIsNone(self.cached_tunes())
+
+    def test_hit_when_only_mtime_changed(self):
+        self.fill_cache()
+        stat = os.stat(self.abc_path)
+        os.utime(self.abc_path, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 10**9))
+        self.assertEqual('The Mountain Road', self.cached_tunes()[0].title)
+
+    def test_clear(self):
+        self.fill_cache()
+        cache = TuneMetadataCache(self.cache_path)
+        cache.load()
+        cache.clear()
+        cache.save()
+        self.assertIsNone(self.cached_tunes())
+
+    def test_lru_eviction(self):
+        cache = TuneMetadataCache(self.cache_path, max_entries=2)
+        paths = []
+        for i in range(3):
+            path = self.dir / 'tune{0}.ly'.format(i)
+            path.write_text('title = "Tune ' + str(i) + '"\n')
+            paths.append(path)
+        cache.put(paths[0], file_fingerprint(paths[0]),
+                  [Tune('Tune 0', path=paths[0])])
+        cache.put(paths[1], file_fingerprint(paths[1]),
+                  [Tune('Tune 1', path=paths[1])])
+        cache.get(paths[0])  # paths[1] becomes the least recently used
+        cache.put(paths[2], file_fingerprint(paths[2]),
+                  [Tune('Tune 2', path=paths[2])])
+        self.assertIsNotNone(cache.get(paths[0]))
+        self.assertIsNone(cache.get(paths[1]))
+        self.assertIsNotNone(cache.get(paths[2]))
+
+    def test_file_modified_while_parsed(self):
+        cache = TuneMetadataCache(self.cache_path)
+        fingerprint = file_fingerprint(self.abc_path)
+        tunes = parse_abc_file(self.abc_path, lazy=True)
+        self.write_abc('X:1\nT:The Twelve Pins\nR:reel\nK:D\nABCD|\n')
+        cache.put(self.abc_path, fingerprint, tunes)
+        self.assertIsNone(cache.get(self.abc_path))
+
+    def test_hit_does_not_rewrite_cache_file(self):
+        self.fill_cache()
+        os.utime(self.cache_path, ns=(0, 0))
+        cache = TuneMetadataCache(self.cache_path)
+        cache.load()
+        self.assertIsNotNone(cache.get(self.abc_path))
+        cache.save()
+        self.assertEqual(0, os.stat(self.cache_path).st_mtime_ns)
+        self.assertEqual(['cache.json', 'tunes.abc'],
+                         sorted(os.listdir(str(self.dir))))
+
+    def test_concurrent_puts_and_gets(self):
+        cache = TuneMetadataCache(self.cache_path, max_entries=10)
+        fingerprint = file_fingerprint(self.abc_path)
+        tunes = parse_abc_file(self.abc_path, lazy=True)
+
+        def use_cache(n):
+            for i in range(200):
+                path = self.dir / 'tunes{0}.abc'.format((n * 200 + i) % 30)
+                cache.put(path, fingerprint, tunes)
+                cache.get(path)
+                cache.sha1(path)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(use_cache, range(8)))
+        self.assertEqual(10, len(cache._entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+import unittest
+
+from watcher import *
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.path = self.dir / 'tune.abc'
+        self.path.write_text('X:1\n')
+        self.other_path = self.dir / 'other.abc'
+        self.other_path.write_text('X:1\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_change_before_wait_is_not_missed(self):
+        watcher = FileWatcher()
+        snapshot = watcher.snapshot([self.path, self.other_path])
+        self.path.write_text('X:2\n')
+        self.assertEqual({self.path}, watcher.wait_for_changes(snapshot))
+
+    def test_deleted_file_is_a_change(self):
+        watcher = FileWatcher()
+        snapshot = watcher.snapshot([self.path])
+        os.remove(str(self.path))
+        self.assertEqual({self.path}, watcher.wait_for_changes(snapshot))
+
+    def test_wait_for_change(self):
+        watcher = FileWatcher()
+        snapshot = watcher.snapshot([self.path, self.other_path])
+
+        def modify():
+            time.sleep(0.1)
+            (self.dir / 'unwatched.abc').write_text('X:1\n')
+            self.other_path.write_text('X:2\n')
+        thread = threading.Thread(target=modify)
+        thread.start()
+        changed = watcher.wait_for_changes(snapshot)
+        thread.join()
+        self.assertEqual({self.other_path}, changed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Timing instrumentation of the tunebook generation
+
+Records the wall time and the number of calls of each stage of the
+generation, the parse time of each tune file and the peak memory usage of
+the process.  The result can be written as JSON (eg for build dashboards)
+or printed as a human-readable table.
+"""
+
+# Imports from the Python Standard Library:
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+TIMINGS_FORMAT_VERSION = 1
+
+
+def peak_memory_kb() -> Optional[int]:
+    """Return the peak resident set size of the process in kB, or None if
+    it cannot be known on this platform"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss // 1024  # bytes on macOS, kB elsewhere
+    return maxrss
+
+
+class Timings:
+    """Wall time and call count per stage, and parse time per file.
+
+    Stages may be nested: the time of a stage includes the time of the
+    stages it contains.  Eg gen_tex_tunebook.py records 'read_list',
+    'load_tunes' (which contains 'parse'), 'template', 'deps_manifest'
+    and 'cache_save', and 'template' contains the stages of
+    TunebookBuilder.stream(): 'check_tunes', 'emit_tunes',
+    'index_of_tunes' and 'index_of_sets'.  Parse times may be recorded
+    from several threads, so 'parse' may exceed 'load_tunes'.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all the recorded timings"""
+        self.start_time = time.perf_counter()
+        self.stages = {}  # name => {'seconds': float, 'calls': int}
+        self.files = {}  # str(path) => {'seconds': float, 'cached': bool}
+        self.counts = {}  # name => int
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager recording the time spent in a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+
+    def record_file(self, path: Path, seconds: float, cached: bool = False):
+        """Record the time spent getting the tunes of a tune file"""
+        with self._lock:
+            self.files[str(path)] = {'seconds': seconds, 'cached': cached}
+
+    def count(self, name: str, n: int = 1):
+        """Increment a counter (eg number of tunes)"""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        return {
+            'version': TIMINGS_FORMAT_VERSION,
+            'total_seconds': time.perf_counter() - self.start_time,
+            'peak_memory_kb': peak_memory_kb(),
+            'stages': self.stages,
+            'counts': self.counts,
+            'files': self.files,
+        }
+
+    def write_json(self, path: Path):
+        """Write the timings to a JSON file"""
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+            f.write('\n')
+        os.replace(str(tmp_path), str(path))
+
+    def print_report(self, file=sys.stderr, slowest_files: int = 10):
+        """Print the timings as a table, slowest stages first"""
+        data = self.as_dict()
+        lines = ['Timings (total: {:.1f} ms)'.format(
+            data['total_seconds'] * 1000)]
+        for name, stage in sorted(self.stages.items(),
+                                  key=lambda item: -item[1]['seconds']):
+            lines.append('    {:<20} {:>10.1f} ms {:>8} calls'.format(
+                name, stage['seconds'] * 1000, stage['calls']))
+        for name, n in sorted(self.counts.items()):
+            lines.append('    {:<20} {:>10}'.format(name, n))
+        parsed_files = [(info['seconds'], path)
+                        for path, info in self.files.items()
+                        if not info['cached']]
+        if parsed_files:
+            lines.append('Slowest parsed files:')
+            for seconds, path in sorted(parsed_files,
+                                        reverse=True)[:slowest_files]:
+                lines.append('    {:>10.1f} ms {}'.format(seconds * 1000,
+                                                         path))
+        if data['peak_memory_kb'] is not None:
+            lines.append('Peak memory: {} kB'.format(data['peak_memory_kb']))
+        print('\n'.join(lines), file=file)
@@ -0,0 +1,423 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Local HTTP service generating tunebooks on demand
+
+The service is started from the root directory of a tunebook project, like
+the other tools.  It generates LilyPond books (.lytex) for lists of tune
+files of the project, without starting a process per request:
+
+    POST /tunebook
+    {
+        "tune_files": ["tunes/our_kate.abc", ...],
+        "tune_sets": ["Set title: our_kate, the_mountain_road", ...],
+        "bookname": "my_tunebook",
+        "pdf": false
+    }
+
+All the fields are optional: by default, the tune files and the sets are
+read from bookspecs/tune_files.txt and bookspecs/tune_sets.txt.  The
+response is the text of the .lytex file.  If "pdf" is true, a PDF build of
+the tunebook is also started in the background with abcbuild.py, and the
+X-Abcbook-Pdf response header tells whether it was started or if a build of
+the same tunebook is still running.  The PDF builds share the build
+directory of the project, so they run one after the other.  The default
+bookname is "requested_tunebook", and the name of a book of the project
+(a <bookname>.abc file in the root directory) is refused.
+
+    GET /status
+
+returns statistics about the service, in JSON format.
+
+The tunes are parsed once and kept in memory, as long as their file does
+not change.  Identical requests received while a tunebook is being
+generated share the same generation.
+"""
+
+# Imports from the Python Standard Library:
+import argparse
+import asyncio
+import hashlib
+from http import HTTPStatus
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# Imports from the project library:
+from gen_tex_tunebook import (OUTPUT_DIR, TEMPLATE_FILENAME,
+                              TUNE_SETS_FILENAME, TunebookBuilder,
+                              TunebookError, load_tune_files,
+                              read_tune_file_list, read_tune_sets)
+from tunecache import DEFAULT_CACHE_PATH, TuneMetadataCache
+
+
+# ------------------------------------------------------------------------
+# Global variables
+# ------------------------------------------------------------------------
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8735
+MAX_REQUEST_SIZE = 1024 * 1024  # bytes
+BOOKNAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Bookname of the requests without one.  It is not the default bookname of
+# the project ('tunebook'), so that a PDF build does not overwrite its book.
+DEFAULT_BOOKNAME = 'requested_tunebook'
+
+# Lists of tune files and sets of the PDF builds
+REQUESTS_DIR = Path('_build') / 'requests'
+
+ARGS = None
+
+
+class RequestError(Exception):
+    """Invalid request, reported to the client with HTTP status 400"""
+
+
+# ------------------------------------------------------------------------
+#     Tunebook service
+# ------------------------------------------------------------------------
+
+class TunebookService:
+    """
+    Generate tunebooks for the requests of the HTTP server.
+
+    Args:
+        project_dir: root directory of the tunebook project
+
+        jobs: maximum number of tunebooks generated at the same time
+    """
+    def __init__(self, project_dir: Path = Path('.'), jobs: int = 4):
+        self.project_dir = project_dir
+        # The tunes of the unchanged files are shared by all the requests.
+        # The cache file of gen_tex_tunebook.py is only read, to start faster
+        self.cache = TuneMetadataCache(project_dir / DEFAULT_CACHE_PATH)
+        self.cache.load()
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._pending = {}  # request key => future of the tunebook text
+        self._pdf_builds = {}  # bookname => task of the PDF build
+        # The PDF builds share the outputs of the build directory
+        self._pdf_build_lock = asyncio.Lock()
+        self.stats = {'requests': 0, 'generations': 0, 'coalesced': 0,
+                      'errors': 0, 'pdf_builds': 0}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    # Generation
+
+    def parse_request(self, request: dict) -> Tuple[List[Path],
+                                                    Optional[List[str]],
+                                                    str]:
+        """
+        Check a tunebook request and fill in the defaults
+
+        Returns:
+            A tuple (tune file paths, lines of the list of sets or None,
+            bookname)
+
+        Raises:
+            RequestError if the request is invalid
+        """
+        if not isinstance(request, dict):
+            raise RequestError('The request must be a JSON object')
+
+        tune_files = request.get('tune_files')
+        if tune_files is None:
+            tune_files = read_tune_file_list(self.project_dir /
+                                             'bookspecs' / 'tune_files.txt')
+        elif (not isinstance(tune_files, list) or
+              not all(isinstance(path, str) for path in tune_files)):
+            raise RequestError('"tune_files" must be a list of paths')
+        tune_file_paths = [self._project_path(path) for path in tune_files]
+
+        tune_sets = request.get('tune_sets')
+        if tune_sets is None:
+            tune_sets = read_tune_sets(self.project_dir / TUNE_SETS_FILENAME)
+        elif (not isinstance(tune_sets, list) or
+              not all(isinstance(line, str) for line in tune_sets)):
+            raise RequestError('"tune_sets" must be a list of lines')
+
+        bookname = request.get('bookname', DEFAULT_BOOKNAME)
+        if not isinstance(bookname, str) or not BOOKNAME_RE.match(bookname):
+            raise RequestError('Invalid "bookname": {0!r}'.format(bookname))
+        if (self.project_dir / (bookname + '.abc')).exists():
+            raise RequestError('"bookname" is a book of the project: {0}'
+                               .format(bookname))
+        return tune_file_paths, tune_sets, bookname
+
+    def _project_path(self, path) -> Path:
+        """Return the path of a tune file of the project.  The clients may
+        not read files outside of the project."""
+        relative_path = Path(path)
+        if relative_path.is_absolute() or '..' in relative_path.parts:
+            raise RequestError('Tune files must be in the project: {0}'
+                               .format(path))
+        return self.project_dir / relative_path
+
+    def generate(self, tune_file_paths: List[Path],
+                 tune_sets: Optional[List[str]]) -> str:
+        """Generate a tunebook (blocking)"""
+        # The cache is thread-safe: the changed files of concurrent
+        # requests are parsed in parallel.  Without timings, nothing is
+        # recorded in the global timings of gen_tex_tunebook.py.
+        tunes_by_file = load_tune_files(tune_file_paths, self.cache)
+        builder = TunebookBuilder.from_template_file(
+            self.project_dir / TEMPLATE_FILENAME, lilypond_dir=OUTPUT_DIR)
+        tunes = [tune for new_tunes in tunes_by_file for tune in new_tunes]
+        return builder.build(tunes, tune_sets, sets_name='request')
+
+    async def get_tunebook(self, tune_file_paths: List[Path],
+                           tune_sets: Optional[List[str]]) -> str:
+        """
+        Generate a tunebook in a worker thread.  If the same tunebook is
+        already being generated, wait for this generation instead.
+
+        Raises:
+            TunebookError, OSError: see generate()
+        """
+        key = request_key(tune_file_paths, tune_sets)
+        future = self._pending.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+
+        self.stats['generations'] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self.generate,
+                                      tune_file_paths, tune_sets)
+        self._pending[key] = future
+        future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # A client going away must not cancel the generation for the others
+        return await asyncio.shield(future)
+
+    # PDF builds
+
+    def start_pdf_build(self, bookname: str, tune_file_paths: List[Path],
+                        tune_sets: Optional[List[str]]) -> str:
+        """
+        Start a PDF build of a tunebook with abcbuild.py, in the background.
+        The build waits for the end of the running PDF build, if any.
+
+        Returns:
+            'started', or 'busy' if a build of the same tunebook is running
+        """
+        task = self._pdf_builds.get(bookname)
+        if task is not None and not task.done():
+            return 'busy'
+
+        requests_dir = self.project_dir / REQUESTS_DIR
+        requests_dir.mkdir(parents=True, exist_ok=True)
+        tune_files_path = requests_dir / (bookname + '.tune_files.txt')
+        tune_files_path.write_text(''.join(
+            str(path.relative_to(self.project_dir)) + '\n'
+            for path in tune_file_paths))
+        command = [sys.executable,
+                   str(Path(__file__).with_name('abcbuild.py')),
+                   'pdf', '--bookname', bookname,
+                   '--tune-file-list', str(tune_files_path.relative_to(
+                       self.project_dir))]
+        if tune_sets is not None:
+            tune_sets_path = requests_dir / (bookname + '.tune_sets.txt')
+            tune_sets_path.write_text(''.join(
+                line if line.endswith('\n') else line + '\n'
+                for line in tune_sets))
+            command += ['--tune-sets',
+                        str(tune_sets_path.relative_to(self.project_dir))]
+
+        self.stats['pdf_builds'] += 1
+        self._pdf_builds[bookname] = asyncio.ensure_future(
+            self._run_pdf_build(bookname, command))
+        return 'started'
+
+    async def _run_pdf_build(self, bookname: str, command: List[str]):
+        log_path = self.project_dir / REQUESTS_DIR / (bookname + '.log')
+        async with self._pdf_build_lock:
+            logging.info('PDF build of %s started', bookname)
+            with open(log_path, 'wb') as log:
+                process = await asyncio.create_subprocess_exec(
+                    *command, cwd=str(self.project_dir), stdout=log,
+                    stderr=asyncio.subprocess.STDOUT)
+                returncode = await process.wait()
+        if returncode == 0:
+            logging.info('PDF build of %s done', bookname)
+        else:
+            logging.error('PDF build of %s failed, see %s', bookname,
+                          log_path)
+
+    # HTTP
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        """Answer an HTTP request, then close the connection"""
+        headers = {}
+        try:
+            method, target, body = await read_http_request(reader)
+            status, content_type, content, headers = \
+                await self.handle_request(method, target, body)
+        except RequestError as e:
+            status, content_type, content = (HTTPStatus.BAD_REQUEST,
+                                             'text/plain', str(e) + '\n')
+        except (TunebookError, OSError) as e:
+            self.stats['errors'] += 1
+            status, content_type, content = (HTTPStatus.UNPROCESSABLE_ENTITY,
+                                             'text/plain', str(e) + '\n')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception:
+            logging.exception('Internal error')
+            self.stats['errors'] += 1
+            status, content_type, content = (HTTPStatus.INTERNAL_SERVER_ERROR,
+                                             'text/plain', 'Internal error\n')
+
+        data = content.encode('utf-8')
+        lines = ['HTTP/1.1 {0} {1}'.format(status.value, status.phrase),
+                 'Content-Type: {0}; charset=utf-8'.format(content_type),
+                 'Content-Length: {0}'.format(len(data)),
+                 'Connection: close']
+        lines += ['{0}: {1}'.format(name, value)
+                  for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.write(data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def handle_request(self, method: str, target: str, body: bytes) \
+            -> Tuple[HTTPStatus, str, str, Dict[str, str]]:
+        """
+        Returns:
+            A tuple (status, content type, content, extra headers)
+        """
+        if target == '/status':
+            if method != 'GET':
+                raise RequestError('Use GET for ' + target)
+            return (HTTPStatus.OK, 'application/json',
+                    json.dumps(self.stats) + '\n', {})
+        if target != '/tunebook':
+            return HTTPStatus.NOT_FOUND, 'text/plain', 'Not found\n', {}
+        if method != 'POST':
+            raise RequestError('Use POST for ' + target)
+
+        self.stats['requests'] += 1
+        try:
+            request = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError as e:
+            raise RequestError('Invalid JSON: {0}'.format(e))
+        tune_file_paths, tune_sets, bookname = self.parse_request(request)
+        lytex = await self.get_tunebook(tune_file_paths, tune_sets)
+
+        headers = {}
+        if request.get('pdf'):
+            headers['X-Abcbook-Pdf'] = self.start_pdf_build(
+                bookname, tune_file_paths, tune_sets)
+        return HTTPStatus.OK, 'text/x-tex', lytex, headers
+
+
+def request_key(tune_file_paths: List[Path],
+                tune_sets: Optional[List[str]]) -> str:
+    """Key identifying the tunebook of a request"""
+    data = json.dumps([[str(path) for path in tune_file_paths], tune_sets])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+async def read_http_request(reader: asyncio.StreamReader) \
+        -> Tuple[str, str, bytes]:
+    """
+    Read an HTTP request
+
+    Returns:
+        A tuple (method, target, body)
+
+    Raises:
+        RequestError if the request is invalid or too large
+    """
+    request_line = (await reader.readline()).decode('latin-1')
+    parts = request_line.split()
+    if len(parts) != 3:
+        raise RequestError('Invalid request line')
+    method, target, _ = parts
+
+    content_length = 0
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if line == '':
+            break
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            try:
+                content_length = int(value)
+            except ValueError:
+                raise RequestError('Invalid Content-Length')
+    if not 0 <= content_length <= MAX_REQUEST_SIZE:
+        raise RequestError('Request too large')
+    body = await reader.readexactly(content_length)
+    return method, target, body
+
+
+async def serve(host: str, port: int, jobs: int):
+    service = TunebookService(jobs=jobs)
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    logging.info('Serving tunebooks on http://%s:%d/', host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+# ----------------------------------------------------------------------------
+#     Entry point & CLI arguments parsing
+# ----------------------------------------------------------------------------
+
+def main(argv: Optional[List[str]] = None):
+    global ARGS
+
+    ARGS = parse_command_line(argv)
+    setup_logging()
+    try:
+        asyncio.run(serve(ARGS.host, ARGS.port, ARGS.jobs))
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_command_line(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Generate tunebooks on demand (to be run from the '
+                    'tunebook root directory)')
+    parser.add_argument('-d', '--debug',
+                        help='show debug messages',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbosity level')
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='maximum number of tunebooks generated at the '
+                             'same time (default: number of CPUs)')
+    return parser.parse_args(argv)
+
+
+def setup_logging():
+    if ARGS.debug:
+        logging_level = logging.DEBUG
+    elif ARGS.verbose:
+        logging_level = logging.INFO
+    else:
+        logging_level = logging.WARNING
+    logging.basicConfig(level=logging_level, format='<%(levelname)s> %(message)s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+On-disk cache of the tune metadata found in tune files
+
+Parsing every tune file listed in a tunebook is the slowest part of
+gen_tex_tunebook.py, whereas only a few files change between two runs.
+The cache stores the metadata of the tunes of each file (title, type, ABC
+index, label, position in the file and SHA-1 of the tune), so that
+unchanged files need not be parsed again.
+
+A cache entry is valid if the file has the same modification time and size
+as when it was cached.  If the modification time changed but not the size
+(eg after a git checkout), the SHA-1 of the file content is compared with
+the cached one before giving up.
+"""
+
+# Imports from the Python Standard Library:
+# Note: hashlib and tempfile are imported where they are used: a run whose
+# tune files are all cached hashes no file and does not save the cache.
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+# Imports from the project library:
+from abcparser import Tune
+
+
+# Bump this number when the format of the cache file changes, or when the
+# cached data (eg tune labels) would be computed differently.
+CACHE_VERSION = 5
+
+DEFAULT_CACHE_PATH = '_build/tune_metadata_cache.json'
+DEFAULT_MAX_ENTRIES = 5000  # Maximum number of cached files
+
+
+T = TypeVar('T')
+
+
+def update_digest(digest, path: Path):
+    """Update a hashlib object with the content of a file"""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+
+
+def file_sha1(path: Path) -> str:
+    """Return the SHA-1 hex digest of the content of a file"""
+    import hashlib
+    sha1 = hashlib.sha1()
+    update_digest(sha1, path)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path: Path) -> Dict[str, Union[int, str]]:
+    """
+    Return the modification time, the size and the SHA-1 of a file, as
+    stored in the cache entries.
+
+    Take the fingerprint of a file before parsing it: if the file is
+    modified in between, the cache entry is invalidated by the next run
+    instead of storing outdated tunes under the new fingerprint.  Parsers
+    which can hash the file while reading it should rather be called with
+    read_with_fingerprint.
+    """
+    return read_with_fingerprint(path, lambda sha1: update_digest(sha1,
+                                                                  path))[0]
+
+
+def read_with_fingerprint(path: Path, read: Callable[[Any], T]) \
+        -> Tuple[Dict[str, Union[int, str]], T]:
+    """
+    Read a file with a function which hashes its content at the same time,
+    eg a parser, so that the file is read only once.
+
+    Args:
+        path: path of the file
+
+        read: function reading the file, called with a hashlib SHA-1
+            object to update with the whole content of the file
+
+    Returns:
+        A tuple (fingerprint of the file as returned by file_fingerprint,
+        result of read)
+    """
+    # The file is stat'ed before it is read, see file_fingerprint
+    import hashlib
+    stat = os.stat(str(path))
+    sha1 = hashlib.sha1()
+    result = read(sha1)
+    return ({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+             'sha1': sha1.hexdigest()}, result)
+
+
+class TuneMetadataCache:
+    """Persistent cache: tune file path => metadata of the tunes in the file
+
+    The least recently used entries are evicted when there are more than
+    max_entries cached files.  The methods may be called from several
+    threads.
+    """
+    def __init__(self, cache_path: Path,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self._entries = {}  # str(path) => entry, least recently used first
+        self._tunes = {}  # str(path) => Tune's built from the entry
+        self._dirty = False
+        # The tunebook server gets and puts tunes from several threads
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the cache file, if any.  An unreadable or outdated cache
+        file is silently ignored."""
+        with self._lock:
+            try:
+                with open(self.cache_path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                logging.debug('No usable tune metadata cache: %s',
+                              self.cache_path)
+                return
+            if (not isinstance(data, dict) or
+                    data.get('version') != CACHE_VERSION):
+                logging.debug('Ignoring outdated tune metadata cache: %s',
+                              self.cache_path)
+                return
+            self._entries = data.get('entries', {})
+            self._tunes = {}
+            logging.debug('Loaded tune metadata cache: %s (%d files)',
+                          self.cache_path, len(self._entries))
+
+    def save(self):
+        """Write the cache file if the cache content changed
+
+        The file is written to a unique temporary file, then renamed, so that
+        concurrent writers (eg several tunebook builds) do not corrupt it.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            import tempfile
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=str(self.cache_path.parent),
+                                            prefix=self.cache_path.name + '.',
+                                            suffix='.tmp')
+            try:
+                with open(fd, 'w') as f:
+                    json.dump({'version': CACHE_VERSION,
+                               'entries': self._entries}, f)
+                os.replace(tmp_path, str(self.cache_path))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self._dirty = False
+
+    def clear(self):
+        """Invalidate all the cache entries"""
+        with self._lock:
+            self._entries = {}
+            self._tunes = {}
+            self._dirty = True
+
+    def get(self, path: Path) -> Optional[List[Tune]]:
+        """
+        Get the tunes of a tune file from the cache
+
+        Args:
+            path: path of the tune file
+
+        Returns:
+            The list of tunes in the file, or None if the file is not in the
+            cache or changed since it was cached.
+        """
+        with self._lock:
+            key = str(path)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            try:
+                stat = os.stat(key)
+            except OSError:
+                return None
+
+            if stat.st_size != entry['size']:
+                return None
+            if stat.st_mtime_ns != entry['mtime_ns']:
+                if file_sha1(path) != entry['sha1']:
+                    return None
+                entry['mtime_ns'] = stat.st_mtime_ns
+                self._dirty = True  # Do not compute the SHA-1 again next time
+
+            # Move the entry to the end of the dict: most recently used.  This
+            # alone does not make the cache dirty: the order is only saved with
+            # the next change, so that warm runs do not rewrite the cache file.
+            del self._entries[key]
+            self._entries[key] = entry
+
+            # Long-running processes (eg gen_tex_tunebook.py --watch) get the
+            # same Tune objects as long as the file does not change
+            tunes = self._tunes.get(key)
+            if tunes is not None:
+                return tunes
+
+            tunes = []
+            for data in entry['tunes']:
+                tune = Tune(data['title'], data['type'], data['index'], path)
+                tune.label = data['label']
+                if data['span'] is not None:
+                    tune.span = tuple(data['span'])
+                    tune.text = None  # Read from the file on access
+                tunes.append(tune)
+            self._tunes[key] = tunes
+            return tunes
+
+    def sha1(self, path: Path) -> Optional[str]:
+        """Return the SHA-1 of a tune file recorded in the cache, or None if
+        the file is not in the cache.  Only valid after get() returned the
+        tunes of the file, or after put()."""
+        with self._lock:
+            entry = self._entries.get(str(path))
+            return entry['sha1'] if entry is not None else None
+
+    def tune_sha1s(self, path: Path) \
+            -> Optional[Dict[Optional[Tuple[int, int]], str]]:
+        """Return the SHA-1 of the tunes of a tune file recorded in the
+        cache, by Tune.span, or None if they are not in the cache.  Only
+        valid after get() returned the tunes of the file, or after put().
+
+        The SHA-1 of a tune is the one of its bytes in the file (see
+        Tune.span), or of the whole file for a tune without span."""
+        with self._lock:
+            entry = self._entries.get(str(path))
+            if entry is None or any(data['sha1'] is None
+                                    for data in entry['tunes']):
+                return None
+            return {tuple(data['span']) if data['span'] is not None else None:
+                    data['sha1'] for data in entry['tunes']}
+
+    def put(self, path: Path, fingerprint: Dict[str, Union[int, str]],
+            tunes: List[Tune], tune_sha1s: Optional[List[str]] = None):
+        """
+        Store the tunes of a tune file in the cache
+
+        Args:
+            path: path of the tune file
+            fingerprint: fingerprint of the file taken before parsing it
+                (see file_fingerprint)
+            tunes: tunes found in the file
+            tune_sha1s: if not None, SHA-1 of each tune in tunes (see
+                tune_sha1s())
+        """
+        with self._lock:
+            if tune_sha1s is None:
+                tune_sha1s = [None] * len(tunes)
+            key = str(path)
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'mtime_ns': fingerprint['mtime_ns'],
+                'size': fingerprint['size'],
+                'sha1': fingerprint['sha1'],
+                'tunes': [{'title': tune.title,
+                           'type': tune.type,
+                           'index': tune.index,
+                           'label': tune.label,
+                           'span': tune.span,
+                           'sha1': sha1}
+                          for tune, sha1 in zip(tunes, tune_sha1s)],
+            }
+            self._tunes[key] = list(tunes)
+            while len(self._entries) > self.max_entries:
+                evicted_key = next(iter(self._entries))
+                del self._entries[evicted_key]
+                self._tunes.pop(evicted_key, None)
+            self._dirty = True
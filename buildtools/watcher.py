@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+"""
+Wait for changes to a set of files
+
+Used by the --watch mode of gen_tex_tunebook.py and abcsplit.py.  On Linux,
+the directories containing the files are watched with inotify, so that a
+change is seen within milliseconds without busy polling.  Elsewhere, or if
+inotify is not available, the files are polled.
+"""
+
+# Imports from the Python Standard Library:
+import ctypes
+import ctypes.util
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+POLL_INTERVAL = 0.05  # seconds
+DEBOUNCE_DELAY = 0.02  # seconds: editors often write a file in several steps
+
+FileSignature = Optional[Tuple[int, int, int]]  # None: missing file
+
+
+def file_signature(path: Path) -> FileSignature:
+    try:
+        stat = os.stat(str(path))
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class _Inotify:
+    """Minimal ctypes binding of the Linux inotify API"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs = {}  # watch descriptor => directory path
+
+    def watch_dir(self, directory: Path):
+        if directory in self._dirs.values():
+            return
+        wd = self._libc.inotify_add_watch(self.fd,
+                                          os.fsencode(str(directory)),
+                                          self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self._dirs[wd] = directory
+
+    def read_paths(self, timeout: Optional[float]) -> Set[Path]:
+        """Wait for events and return the paths of the changed files"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self._dirs and name:
+                paths.add(self._dirs[wd] / os.fsdecode(name))
+        return paths
+
+
+class FileWatcher:
+    """Wait for changes to a set of files, with inotify or by polling"""
+
+    def __init__(self):
+        try:
+            self._inotify = _Inotify()
+            logging.debug('Watching files with inotify')
+        except (OSError, AttributeError, TypeError) as e:
+            logging.debug('inotify not available (%s): polling files', e)
+            self._inotify = None
+
+    @staticmethod
+    def snapshot(paths: Iterable[Path]) -> Dict[Path, FileSignature]:
+        """Record the state of a set of files"""
+        return {path: file_signature(path) for path in paths}
+
+    def wait_for_changes(self, snapshot: Dict[Path, FileSignature]) \
+            -> Set[Path]:
+        """
+        Block until at least one of the files of a snapshot changed.
+
+        Changes made since the snapshot was taken are returned immediately,
+        so no change is missed while the caller processes the previous ones.
+
+        Args:
+            snapshot: state of the files to watch, from snapshot()
+
+        Returns:
+            The set of changed files
+        """
+        watched = {}  # absolute path => path as given by the caller
+        for path in snapshot:
+            watched[Path(os.path.abspath(str(path)))] = path
+        if self._inotify is not None:
+            for abs_path in watched:
+                try:
+                    self._inotify.watch_dir(abs_path.parent)
+                except OSError as e:
+                    logging.warning('Cannot watch %s: %s', abs_path.parent, e)
+
+        while True:
+            changed = self._changed_files(snapshot)
+            if changed:
+                # Let the editor finish writing, then collect all the changes
+                time.sleep(DEBOUNCE_DELAY)
+                return self._changed_files(snapshot)
+            if self._inotify is not None:
+                # Block until an event occurs on one of the watched files
+                while not (self._inotify.read_paths(timeout=None) &
+                           watched.keys()):
+                    pass
+            else:
+                time.sleep(POLL_INTERVAL)
+
+    @staticmethod
+    def _changed_files(snapshot: Dict[Path, FileSignature]) -> Set[Path]:
+        return {path for path, signature in snapshot.items()
+                if file_signature(path) != signature}